@@ -6,13 +6,175 @@
 # Version: 1.0.1 - Fixed OpenCV dependencies for cloud deployment
 import streamlit as st
 from ultralytics import YOLO
+from ultralytics.engine.results import Results
+import torch
+from torchvision.ops import batched_nms
 import cv2
 import numpy as np
 from PIL import Image, ImageDraw, ImageFont
 from datetime import datetime
 import json
 import os
+import time
+import hashlib
+import io
+import re
+import shutil
+import tempfile
+import queue
+import threading
+import weakref
+from collections import OrderedDict, deque
+import multiprocessing
+from multiprocessing import shared_memory
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeout
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager
 import auth
+import inference_worker
+
+# =============================================================================
+# PERFORMANCE CONFIGURATION (Read from environment, see .env.example)
+# =============================================================================
+def env_flag(name, default=False):
+    """Read a true/false switch from the environment"""
+    value = os.environ.get(name)
+    if value is None:
+        return default
+    return value.strip().lower() in ("1", "true", "yes", "on")
+
+# Run fruit_expert and leaf_expert at the same time in Auto-Detect mode
+PARALLEL_EXPERTS = env_flag("PARALLEL_EXPERTS", True)
+# Threads shared by all sessions for running experts concurrently
+EXPERT_POOL_WORKERS = int(os.environ.get("EXPERT_POOL_WORKERS", "4"))
+# Auto-Detect routing: "both" always runs both experts, "gatekeeper" lets
+# Classifier.pt pick the expert(s) first
+AUTO_DETECT_ROUTING = os.environ.get("AUTO_DETECT_ROUTING", "both").strip().lower()
+# Thumbnail size the gatekeeper classifies at
+GATEKEEPER_IMGSZ = int(os.environ.get("GATEKEEPER_IMGSZ", "224"))
+# Below this gatekeeper confidence both experts still run
+GATEKEEPER_MARGIN = float(os.environ.get("GATEKEEPER_MARGIN", "0.6"))
+# Images per batched predict call in Batch Mode
+BATCH_SIZE = int(os.environ.get("BATCH_SIZE", "8"))
+# Cross-session micro-batching: group predict calls from all sessions
+MICROBATCH_ENABLED = env_flag("MICROBATCH_ENABLED", False)
+# How long the scheduler waits for more requests before running a batch
+MICROBATCH_WINDOW_MS = float(os.environ.get("MICROBATCH_WINDOW_MS", "10"))
+MICROBATCH_MAX_BATCH = int(os.environ.get("MICROBATCH_MAX_BATCH", "8"))
+# Inference runtime: "torch" (eager PyTorch), "onnx" (ONNX Runtime) or "openvino"
+INFERENCE_BACKEND = os.environ.get("INFERENCE_BACKEND", "torch").strip().lower()
+# Network input size of the detection experts
+DETECT_IMGSZ = int(os.environ.get("DETECT_IMGSZ", "640"))
+# INT8 quantized models (comma separated keys, e.g. "fruit_expert,leaf_expert")
+INT8_MODELS = [key.strip() for key in os.environ.get("INT8_MODELS", "").split(",") if key.strip()]
+# "static" (calibrated from QUANT_CALIBRATION_DIR) or "dynamic"
+QUANT_METHOD = os.environ.get("QUANT_METHOD", "static").strip().lower()
+# Sample images used for calibration and for the accuracy check
+QUANT_CALIBRATION_DIR = os.environ.get("QUANT_CALIBRATION_DIR", "calibration_images")
+# Refuse an INT8 model that disagrees with the float model on more images than this
+QUANT_MAX_DISAGREEMENT = float(os.environ.get("QUANT_MAX_DISAGREEMENT", "0.05"))
+# Largest confidence difference still counted as agreement
+QUANT_CONF_TOLERANCE = float(os.environ.get("QUANT_CONF_TOLERANCE", "0.15"))
+# Two-tier resolution: infer at LOW_RES_IMGSZ first, re-run at DETECT_IMGSZ
+# when nothing is found or the best confidence is below ESCALATION_CONF
+ADAPTIVE_RESOLUTION = env_flag("ADAPTIVE_RESOLUTION", False)
+LOW_RES_IMGSZ = int(os.environ.get("LOW_RES_IMGSZ", "320"))
+ESCALATION_CONF = float(os.environ.get("ESCALATION_CONF", "0.5"))
+# Sliced inference for large photos: overlapping tiles merged with cross-tile NMS
+TILED_INFERENCE = env_flag("TILED_INFERENCE", False)
+TILE_SIZE = int(os.environ.get("TILE_SIZE", "640"))
+TILE_OVERLAP = float(os.environ.get("TILE_OVERLAP", "0.2"))
+MAX_TILES = int(os.environ.get("MAX_TILES", "16"))
+TILE_NMS_IOU = float(os.environ.get("TILE_NMS_IOU", "0.5"))
+# Ingest: uploads above this many pixels are rejected before decoding
+MAX_IMAGE_PIXELS = int(float(os.environ.get("MAX_IMAGE_PIXELS", "60000000")))
+# Decode large photos at reduced resolution (JPEG DCT scaling), keeping at
+# least the long edge the models need (DECODE_MIN_EDGE, 0 = derive it from
+# DETECT_IMGSZ or the tiling settings)
+REDUCED_DECODE = env_flag("REDUCED_DECODE", True)
+DECODE_MIN_EDGE = int(os.environ.get("DECODE_MIN_EDGE", "0"))
+# Saved scans get a small thumbnail (Recent Scans list) and a medium preview
+# (opened scan); the original is only read when explicitly downloaded
+SCAN_THUMBNAIL_SIZE = int(os.environ.get("SCAN_THUMBNAIL_SIZE", "256"))
+SCAN_PREVIEW_SIZE = int(os.environ.get("SCAN_PREVIEW_SIZE", "1024"))
+# Saved originals are transcoded in the background to webp or jpeg, capped
+# at SCAN_MAX_EDGE px and SCAN_MAX_BYTES (quality steps down from
+# SCAN_QUALITY to SCAN_MIN_QUALITY until it fits)
+SCAN_STORAGE_FORMAT = os.environ.get("SCAN_STORAGE_FORMAT", "webp").strip().lower()
+SCAN_MAX_EDGE = int(os.environ.get("SCAN_MAX_EDGE", "2048"))
+SCAN_MAX_BYTES = int(os.environ.get("SCAN_MAX_BYTES", "500000"))
+SCAN_QUALITY = int(os.environ.get("SCAN_QUALITY", "85"))
+SCAN_MIN_QUALITY = int(os.environ.get("SCAN_MIN_QUALITY", "50"))
+SCAN_TRANSCODE_ASYNC = env_flag("SCAN_TRANSCODE_ASYNC", True)
+# Keep each scan's boxes (compact .npz) so past scans can be redrawn without
+# the models; optionally also cache the annotated image at preview size
+SAVE_DETECTIONS = env_flag("SAVE_DETECTIONS", True)
+SAVE_ANNOTATED_PREVIEW = env_flag("SAVE_ANNOTATED_PREVIEW", False)
+# Latency budget per analysis request in ms (0 = no deadline). When the
+# remaining budget would not cover a stage, it is downgraded or skipped
+REQUEST_BUDGET_MS = float(os.environ.get("REQUEST_BUDGET_MS", "0"))
+# Auto-Detect: merge boxes the fruit and leaf experts both report for one region
+DUPLICATE_SUPPRESSION = env_flag("DUPLICATE_SUPPRESSION", True)
+DUPLICATE_IOU = float(os.environ.get("DUPLICATE_IOU", "0.5"))
+# Per class-pair rules, "fruit_class:leaf_class=action[@iou]" separated by
+# commas; '*' matches any class, '#ripeness' / '#healthy' / '#disease' any
+# class of that category, later rules win. Actions: higher (keep the more
+# confident box), fruit, leaf, both (no suppression, also for unmatched pairs).
+# The default only merges a region reported as both a fruit and a leaf disease
+DUPLICATE_RULES = os.environ.get("DUPLICATE_RULES", "#disease:#disease=higher")
+# Process-wide cache of detection results keyed by image hash + model + settings
+RESULT_CACHE_ENABLED = env_flag("RESULT_CACHE_ENABLED", True)
+RESULT_CACHE_MAX_ENTRIES = int(os.environ.get("RESULT_CACHE_MAX_ENTRIES", "512"))
+RESULT_CACHE_MAX_MB = float(os.environ.get("RESULT_CACHE_MAX_MB", "64"))
+# Run every model on synthetic inputs before the pipeline reports ready
+WARMUP_ENABLED = env_flag("WARMUP_ENABLED", True)
+# Timed runs after the first call, used for the steady-state latency
+WARMUP_RUNS = int(os.environ.get("WARMUP_RUNS", "3"))
+# Load each model on first use instead of all at startup
+LAZY_MODEL_LOADING = env_flag("LAZY_MODEL_LOADING", True)
+# Models to load in the background once the UI is up ("auto" = the models the
+# configured modes can reach, "all" or comma separated keys)
+PRELOAD_MODELS = os.environ.get("PRELOAD_MODELS", "auto").strip()
+# Versioned weights (e.g. models/TomatoLeavesDiseases_v3.pt) are picked up from
+# MODELS_DIR and swapped in without a restart
+MODELS_DIR = os.environ.get("MODELS_DIR", "models")
+MODEL_WATCH_ENABLED = env_flag("MODEL_WATCH_ENABLED", True)
+MODEL_WATCH_INTERVAL = float(os.environ.get("MODEL_WATCH_INTERVAL", "30"))
+# Independent instances per model that sessions check out for each predict
+MODEL_POOL_SIZE = int(os.environ.get("MODEL_POOL_SIZE", "1"))
+# Per-model overrides, e.g. "fruit_expert=3,leaf_expert=2"
+MODEL_POOL_SIZES = {
+    key.strip(): int(size)
+    for key, size in (item.split("=") for item in os.environ.get("MODEL_POOL_SIZES", "").split(",") if "=" in item)
+}
+# Run the detection experts in this many worker processes each (0 = in-process)
+WORKER_PROCESSES = int(os.environ.get("WORKER_PROCESSES", "0"))
+# Replace a worker after this many tasks (0 = never)
+WORKER_MAX_TASKS = int(os.environ.get("WORKER_MAX_TASKS", "1000"))
+# Recycle the workers when one grows beyond this resident memory
+WORKER_MAX_RSS_MB = float(os.environ.get("WORKER_MAX_RSS_MB", "2048"))
+# Concurrent inference slots the cores are split between (0 = work it out from
+# WORKER_PROCESSES / MODEL_POOL_SIZE / PARALLEL_EXPERTS)
+INFERENCE_SLOTS = int(os.environ.get("INFERENCE_SLOTS", "0"))
+# Threads per slot (0 = cores / slots for intra-op, 1 for inter-op and OpenCV)
+TORCH_INTRA_OP_THREADS = int(os.environ.get("TORCH_INTRA_OP_THREADS", "0"))
+TORCH_INTER_OP_THREADS = int(os.environ.get("TORCH_INTER_OP_THREADS", "0"))
+CV2_THREADS = int(os.environ.get("CV2_THREADS", "0"))
+# CPU pinning: "" = off, "auto" = pin each worker process to its own cores
+# (pins nothing unless WORKER_PROCESSES > 0), or a core list like "0-7,16-23"
+# that the app and its workers are limited to
+CPU_AFFINITY = os.environ.get("CPU_AFFINITY", "").strip()
+# Video Mode: experts only run on keyframes, boxes are tracked in between
+VIDEO_MAX_KEYFRAME_INTERVAL = int(os.environ.get("VIDEO_MAX_KEYFRAME_INTERVAL", "15"))
+VIDEO_MIN_KEYFRAME_INTERVAL = int(os.environ.get("VIDEO_MIN_KEYFRAME_INTERVAL", "3"))
+# Mean gray-level change (0-255) since the last keyframe that forces a new one
+VIDEO_MOTION_THRESHOLD = float(os.environ.get("VIDEO_MOTION_THRESHOLD", "12"))
+VIDEO_TRACK_IOU = float(os.environ.get("VIDEO_TRACK_IOU", "0.3"))
+# Keyframes a track may go unmatched before it is closed
+VIDEO_MAX_MISSES = int(os.environ.get("VIDEO_MAX_MISSES", "2"))
+# Width frames are processed and written at
+VIDEO_WIDTH = int(os.environ.get("VIDEO_WIDTH", "960"))
 
 # =============================================================================
 # PAGE CONFIGURATION
@@ -85,6 +247,382 @@ if 'camera_mode' not in st.session_state:
 # HELPER FUNCTIONS (Define these early so they can be used anywhere)
 # =============================================================================
 
+SCAN_IMAGE_VARIANTS = {'preview': SCAN_PREVIEW_SIZE, 'thumb': SCAN_THUMBNAIL_SIZE}
+
+def scan_image_variant(image_path, variant):
+    """Path of a derived image ('preview' or 'thumb') stored next to the original"""
+    stem, _ = os.path.splitext(image_path)
+    return f"{stem}_{variant}.jpg"
+
+def create_scan_previews(image_path, image_data=None, image=None):
+    """
+    Write the preview and thumbnail of a saved scan image
+    
+    The original is decoded once (JPEG draft mode decodes it straight at
+    about preview size), then each variant is shrunk from the previous one.
+    An already decoded PIL image can be passed instead.
+    
+    Returns:
+        dict: variant -> path of the files that were written
+    """
+    paths = {}
+    try:
+        if image is not None:
+            img = image.copy()
+        else:
+            with Image.open(io.BytesIO(image_data) if image_data is not None else image_path) as original:
+                original.draft("RGB", (SCAN_PREVIEW_SIZE, SCAN_PREVIEW_SIZE))
+                img = original.convert("RGB")
+        for variant, size in SCAN_IMAGE_VARIANTS.items():
+            img.thumbnail((size, size))
+            path = scan_image_variant(image_path, variant)
+            # The panel and the storage job can write the same variant at
+            # once; readers only ever see a complete file
+            temp_path = f"{path}.{threading.get_ident()}.tmp"
+            img.save(temp_path, "JPEG", quality=85, optimize=True)
+            os.replace(temp_path, path)
+            paths[variant] = path
+    except Exception as e:
+        print(f"Error creating previews for {image_path}: {e}")
+    return paths
+
+def scan_display_image(scan, variant):
+    """Thumbnail / preview path of a scan, created on first use for older scans (None without image)"""
+    image_path = scan.get('image_path')
+    if image_path and not os.path.exists(image_path):
+        # Transcoded in the background since this session loaded it
+        image_path = scan['image_path'] = current_image_path(scan)
+    if not image_path or not os.path.exists(image_path):
+        return None
+    path = scan_image_variant(image_path, variant)
+    if not os.path.exists(path):
+        path = create_scan_previews(image_path).get(variant)
+    return path
+
+def remove_scan_files(scan):
+    """Delete the image of a scan together with its preview and thumbnail"""
+    image_path = scan.get('image_path')
+    if not image_path:
+        return
+    for path in [image_path] + [scan_image_variant(image_path, variant) for variant in SCAN_IMAGE_VARIANTS]:
+        if os.path.exists(path):
+            try:
+                os.remove(path)
+            except:
+                pass
+
+# =============================================================================
+# SCAN STORAGE (History file lock + background transcoding)
+# =============================================================================
+IMAGE_EXTENSIONS = {"JPEG": ".jpg", "MPO": ".jpg", "PNG": ".png", "WEBP": ".webp", "TIFF": ".tif", "BMP": ".bmp", "GIF": ".gif"}
+
+@st.cache_resource
+def get_history_lock():
+    """Guards every read-modify-write of scan_history.json (all sessions and storage jobs)"""
+    return threading.RLock()
+
+@st.cache_resource
+def get_storage_executor():
+    """Single background thread that transcodes saved scans off the request path"""
+    return ThreadPoolExecutor(max_workers=1, thread_name_prefix="storage")
+
+def write_history(history, history_file="scan_history.json"):
+    """Replace the history file atomically so readers never see it half-written"""
+    temp_file = history_file + ".tmp"
+    with open(temp_file, 'w') as f:
+        json.dump(history, f, indent=4)
+    os.replace(temp_file, history_file)
+
+def image_extension(image_data):
+    """File extension of the real format of image bytes ('.jpg' if unknown)"""
+    try:
+        with Image.open(io.BytesIO(image_data)) as img:
+            return IMAGE_EXTENSIONS.get(img.format, ".jpg")
+    except Exception:
+        return ".jpg"
+
+def current_image_path(scan, history_file="scan_history.json"):
+    """Image path of a scan as currently recorded in the history file"""
+    with get_history_lock():
+        try:
+            with open(history_file, 'r') as f:
+                history = json.load(f)
+        except Exception:
+            return None
+    for entry in history:
+        if entry.get('scan_id') == scan.get('scan_id'):
+            return entry.get('image_path')
+    return None
+
+def encode_within_budget(img, image_format, exif=b""):
+    """Encode at the highest quality step that fits SCAN_MAX_BYTES (the lowest step otherwise)"""
+    quality = SCAN_QUALITY
+    while True:
+        buffer = io.BytesIO()
+        if image_format == "WEBP":
+            img.save(buffer, "WEBP", quality=quality, method=4, exif=exif)
+        else:
+            img.save(buffer, "JPEG", quality=quality, optimize=True, progressive=True, exif=exif)
+        if buffer.tell() <= SCAN_MAX_BYTES or quality <= SCAN_MIN_QUALITY:
+            return buffer.getvalue(), quality
+        quality = max(SCAN_MIN_QUALITY, quality - 10)
+
+def transcode_scan_image(image_path, history_file="scan_history.json"):
+    """
+    Storage job: shrink a saved original and record its new path
+    
+    Originals that are already JPEG/WebP within the edge and byte limits
+    are kept untouched (no generation loss). Everything else is capped at
+    SCAN_MAX_EDGE, encoded as SCAN_STORAGE_FORMAT within the byte budget
+    and stored under its real extension; previews are made from the same
+    decoded image. The history entry is updated under the history lock.
+    """
+    try:
+        with Image.open(image_path) as original:
+            source_format = original.format
+            source_size = original.size
+            keep = (source_format in ("JPEG", "WEBP") and max(source_size) <= SCAN_MAX_EDGE
+                    and os.path.getsize(image_path) <= SCAN_MAX_BYTES)
+            if not keep:
+                # Keep the EXIF block: the orientation tag tells viewers how to
+                # rotate the pixels, saved boxes stay in raw pixel orientation
+                exif = original.info.get("exif") or b""
+                original.draft("RGB", (SCAN_MAX_EDGE, SCAN_MAX_EDGE))
+                img = original.convert("RGB")
+        if keep:
+            create_scan_previews(image_path)
+            return image_path
+        
+        img.thumbnail((SCAN_MAX_EDGE, SCAN_MAX_EDGE))
+        target_format = "WEBP" if SCAN_STORAGE_FORMAT == "webp" else "JPEG"
+        data, quality = encode_within_budget(img, target_format, exif=exif)
+        new_path = os.path.splitext(image_path)[0] + IMAGE_EXTENSIONS[target_format]
+        with open(new_path + ".tmp", "wb") as f:
+            f.write(data)
+        os.replace(new_path + ".tmp", new_path)
+        create_scan_previews(new_path, image=img)
+    except Exception as e:
+        print(f"Error transcoding {image_path}: {e}")
+        return image_path
+    
+    with get_history_lock():
+        history = []
+        if os.path.exists(history_file):
+            with open(history_file, 'r') as f:
+                history = json.load(f)
+        entries = [entry for entry in history if entry.get('image_path') == image_path]
+        for entry in entries:
+            entry['image_path'] = new_path
+        if entries:
+            write_history(history, history_file)
+    
+    if not entries:
+        # The scan was deleted while the job was queued
+        remove_scan_files({'image_path': new_path})
+    if new_path != image_path and os.path.exists(image_path):
+        os.remove(image_path)
+    print(f"Stored {os.path.basename(new_path)}: {source_format} {source_size[0]}x{source_size[1]} -> "
+          f"{target_format} {img.size[0]}x{img.size[1]} q{quality}, {len(data) / 1024:.0f} KB")
+    return new_path
+
+# =============================================================================
+# BLOB STORE (Content-addressed, sharded, reference counted)
+# =============================================================================
+# Scan images live at user_scans/ab/cd/<sha256 of the upload><ext>; identical
+# uploads share one file. A small <sha256>.refs sidecar next to each blob
+# counts the history entries using it, so saving or deleting a scan only
+# touches that blob's counter. All functions here expect the history lock held.
+BLOB_ROOT = "user_scans"
+# Single refcount file of older versions, split into sidecars on first use
+LEGACY_BLOB_REFS_FILE = os.path.join(BLOB_ROOT, "blob_refs.json")
+
+def blob_dir(key):
+    """Two-level shard directory of a blob (first two byte pairs of its hash)"""
+    return os.path.join(BLOB_ROOT, key[:2], key[2:4])
+
+def blob_refs_path(key):
+    return os.path.join(blob_dir(key), key + ".refs")
+
+def find_blob(key):
+    """Current file of a blob (None if not stored), ignoring its previews"""
+    directory = blob_dir(key)
+    if not os.path.isdir(directory):
+        return None
+    candidates = [
+        os.path.join(directory, name) for name in os.listdir(directory)
+        if os.path.splitext(name)[0] == key and not name.endswith((".tmp", ".refs"))
+    ]
+    # During a transcode both files exist for a moment; the newer one wins
+    return max(candidates, key=os.path.getmtime) if candidates else None
+
+def load_blob_refs(key):
+    """Number of history entries using a blob (0 if none)"""
+    try:
+        with open(blob_refs_path(key), 'r') as f:
+            return int(f.read().strip() or 0)
+    except (OSError, ValueError):
+        return 0
+
+def save_blob_refs(key, count):
+    """Write one blob's counter atomically (removed at 0)"""
+    path = blob_refs_path(key)
+    if count <= 0:
+        if os.path.exists(path):
+            os.remove(path)
+        return
+    os.makedirs(blob_dir(key), exist_ok=True)
+    with open(path + ".tmp", 'w') as f:
+        f.write(str(count))
+    os.replace(path + ".tmp", path)
+
+@st.cache_resource
+def migrate_blob_refs():
+    """Split the old blob_refs.json into per-blob sidecars once per process"""
+    if not os.path.exists(LEGACY_BLOB_REFS_FILE):
+        return 0
+    with get_history_lock():
+        try:
+            with open(LEGACY_BLOB_REFS_FILE, 'r') as f:
+                refs = json.load(f)
+        except (OSError, ValueError):
+            return 0
+        for key, count in refs.items():
+            if not os.path.exists(blob_refs_path(key)):
+                save_blob_refs(key, count)
+        os.replace(LEGACY_BLOB_REFS_FILE, LEGACY_BLOB_REFS_FILE + ".migrated")
+    print(f"Migrated {len(refs)} blob reference count(s) to sidecar files")
+    return len(refs)
+
+def store_blob(image_data):
+    """
+    Add a reference to the blob of some image bytes, writing it if new
+    
+    Returns:
+        tuple: (key, path, created) - created is False for a duplicate upload
+    """
+    migrate_blob_refs()
+    key = hashlib.sha256(image_data).hexdigest()
+    path = find_blob(key)
+    created = path is None
+    if created:
+        os.makedirs(blob_dir(key), exist_ok=True)
+        path = os.path.join(blob_dir(key), key + image_extension(image_data))
+        with open(path + ".tmp", "wb") as f:
+            f.write(image_data)
+        os.replace(path + ".tmp", path)
+    save_blob_refs(key, load_blob_refs(key) + 1)
+    return key, path, created
+
+def release_blob(scan):
+    """Drop a history entry's reference to its image; the files go with the last one"""
+    key = scan.get('image_key')
+    if not key:
+        # Scans saved before the blob store own their file
+        remove_scan_files(scan)
+        return
+    migrate_blob_refs()
+    count = max(1, load_blob_refs(key)) - 1
+    save_blob_refs(key, count)
+    if count <= 0:
+        remove_scan_files({'image_path': find_blob(key) or scan.get('image_path')})
+
+# =============================================================================
+# SAVED DETECTIONS (Compact per-scan boxes + optional annotated preview)
+# =============================================================================
+DETECTION_CATEGORIES = ["ripeness", "healthy", "disease"]
+DETECTION_SOURCES = ["fruit", "leaf"]
+
+def draw_labeled_boxes(img_pil, boxes, names, confs, good):
+    """Draw boxes and labels (green where good, red elsewhere) onto a PIL image"""
+    draw = ImageDraw.Draw(img_pil)
+    colors = np.where(good, "#4CAF50", "#F44336").tolist()
+    for (x1, y1, x2, y2), name, conf, color in zip(np.asarray(boxes).astype(int).tolist(), list(names), list(confs), colors):
+        draw.rectangle([x1, y1, x2, y2], outline=color, width=4)
+        draw.text((x1, y1-20), f"{name} {float(conf):.1%}", fill=color)
+    return img_pil
+
+def scan_detections_path(scan_id):
+    """Sharded location of a scan's saved detections"""
+    key = hashlib.sha256(scan_id.encode()).hexdigest()
+    return os.path.join(BLOB_ROOT, "detections", key[:2], key[2:4], key + ".npz")
+
+def save_scan_detections(scan_id, detections, image_size, model_versions):
+    """
+    Write a scan's Detections as one compressed .npz
+    
+    Boxes stay in the coordinates of the analyzed image (image_size), class
+    names are stored once and referenced by index, confidences as float16.
+    
+    Returns:
+        str: Path of the file (None if it could not be written)
+    """
+    path = scan_detections_path(scan_id)
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        labels, name_index = np.unique(detections.name, return_inverse=True)
+        with open(path + ".tmp", "wb") as f:
+            np.savez_compressed(
+                f,
+                xyxy=detections.xyxy.astype(np.float32),
+                conf=detections.conf.astype(np.float16),
+                cls=detections.cls.astype(np.int16),
+                name=name_index.astype(np.int16),
+                labels=labels,
+                source=(detections.source[:, None] == np.array(DETECTION_SOURCES)).argmax(axis=1).astype(np.uint8),
+                category=(detections.category[:, None] == np.array(DETECTION_CATEGORIES)).argmax(axis=1).astype(np.uint8),
+                image_size=np.array(image_size, dtype=np.int32),
+                model_versions=np.array(json.dumps(model_versions or {}))
+            )
+        os.replace(path + ".tmp", path)
+        return path
+    except Exception as e:
+        print(f"Error saving detections for {scan_id}: {e}")
+        return None
+
+def load_scan_detections(path):
+    """Saved detections of a scan as a dict of arrays (None if missing)"""
+    try:
+        with np.load(path, allow_pickle=False) as data:
+            saved = {name: data[name] for name in data.files}
+    except (OSError, ValueError):
+        return None
+    saved['names'] = saved['labels'][saved['name']] if len(saved['name']) else np.zeros(0, dtype=str)
+    saved['model_versions'] = json.loads(str(saved['model_versions']))
+    return saved
+
+def render_scan_detections(image_path, saved):
+    """Redraw saved boxes onto a stored image of any size (preview, original)"""
+    img = Image.open(image_path).convert("RGB")
+    scale = img.size[0] / max(1, int(saved['image_size'][0]))
+    good = (saved['category'] == DETECTION_CATEGORIES.index("healthy")) | (np.char.lower(saved['names']) == "ripe")
+    return draw_labeled_boxes(img, saved['xyxy'] * scale, saved['names'].tolist(), saved['conf'].tolist(), good)
+
+def save_annotated_preview(annotated_image, path):
+    """Storage job: shrink an annotated result to preview size and save it"""
+    try:
+        annotated_image.thumbnail((SCAN_PREVIEW_SIZE, SCAN_PREVIEW_SIZE))
+        annotated_image.save(path + ".tmp", "JPEG", quality=85, optimize=True)
+        os.replace(path + ".tmp", path)
+    except Exception as e:
+        print(f"Error saving annotated preview {path}: {e}")
+
+def remove_scan_detections(scan):
+    """Delete a scan's saved detections and annotated preview"""
+    for key in ('detections_path', 'annotated_path'):
+        path = scan.get(key)
+        if path and os.path.exists(path):
+            try:
+                os.remove(path)
+            except:
+                pass
+
+def schedule_transcode(image_path):
+    """Queue the storage job for a newly saved image (inline when SCAN_TRANSCODE_ASYNC is off)"""
+    if SCAN_TRANSCODE_ASYNC:
+        get_storage_executor().submit(transcode_scan_image, image_path)
+    else:
+        transcode_scan_image(image_path)
+
 def load_user_history():
     """Load scan history for current user from JSON file"""
     history_file = "scan_history.json"
@@ -92,8 +630,9 @@ def load_user_history():
     
     if os.path.exists(history_file):
         try:
-            with open(history_file, 'r') as f:
-                history = json.load(f)
+            with get_history_lock():
+                with open(history_file, 'r') as f:
+                    history = json.load(f)
             # Filter for current user only
             user_scans = [s for s in history if s.get('username') == username]
             return user_scans
@@ -106,44 +645,49 @@ def delete_scan(scan_id):
     history_file = "scan_history.json"
     username = st.session_state.get('username', 'Guest')
     
-    if os.path.exists(history_file):
-        try:
-            with open(history_file, 'r') as f:
-                history = json.load(f)
-            
-            # Find and remove the scan
-            scan_to_delete = None
-            for scan in history:
-                if scan.get('scan_id') == scan_id and scan.get('username') == username:
-                    scan_to_delete = scan
-                    break
-            
-            if scan_to_delete:
-                # Delete associated image if it exists
-                img_path = scan_to_delete.get('image_path')
-                if img_path and os.path.exists(img_path):
-                    try:
-                        os.remove(img_path)
-                    except:
-                        pass
-                
-                # Remove from history
-                history.remove(scan_to_delete)
+    # Read-modify-write under the lock shared with other sessions and storage jobs
+    with get_history_lock():
+        if os.path.exists(history_file):
+            try:
+                with open(history_file, 'r') as f:
+                    history = json.load(f)
                 
-                # Save updated history
-                with open(history_file, 'w') as f:
-                    json.dump(history, f, indent=4)
+                # Find and remove the scan
+                scan_to_delete = None
+                for scan in history:
+                    if scan.get('scan_id') == scan_id and scan.get('username') == username:
+                        scan_to_delete = scan
+                        break
                 
-                # Update session state
-                st.session_state.recent_scans = [s for s in history if s.get('username') == username]
-                return True
-        except Exception as e:
-            st.error(f"Error deleting scan: {e}")
-            return False
+                if scan_to_delete:
+                    # Release its image (deleted with the last scan using it)
+                    release_blob(scan_to_delete)
+                    remove_scan_detections(scan_to_delete)
+                    
+                    # Remove from history
+                    history.remove(scan_to_delete)
+                    
+                    # Save updated history
+                    write_history(history, history_file)
+                    
+                    # Update session state
+                    st.session_state.recent_scans = [s for s in history if s.get('username') == username]
+                    return True
+            except Exception as e:
+                st.error(f"Error deleting scan: {e}")
+                return False
     return False
 
-def save_scan_to_history(mode, status, ripeness, diseases, image_file=None):
-    """Saves scan data to a JSON file so it persists after Logout"""
+def save_scan_to_history(mode, status, ripeness, diseases, image_file=None, model_versions=None, degraded=None,
+                         image_data=None, detections=None, image_size=None, annotated_image=None):
+    """
+    Saves scan data to a JSON file so it persists after Logout
+    
+    image_data: upload bytes already read. detections / image_size: the
+    scan's Detections and the (width, height) they refer to, kept so the
+    boxes can be redrawn later. annotated_image: rendered result (PIL),
+    cached at preview size when SAVE_ANNOTATED_PREVIEW is on.
+    """
     history_file = "scan_history.json"
     username = st.session_state.get('username', 'Guest')
     
@@ -152,22 +696,10 @@ def save_scan_to_history(mode, status, ripeness, diseases, image_file=None):
     if not os.path.exists(scans_dir):
         os.makedirs(scans_dir)
     
-    # Save image if provided
-    image_path = None
-    if image_file is not None:
-        try:
-            # Reset file pointer to beginning
-            image_file.seek(0)
-            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-            image_filename = f"{username}_{timestamp}.jpg"
-            image_path = os.path.join(scans_dir, image_filename)
-            
-            # Save image to disk
-            with open(image_path, "wb") as f:
-                f.write(image_file.getvalue())
-        except Exception as e:
-            st.error(f"Error saving image: {e}")
-            image_path = None
+    if image_data is None and image_file is not None:
+        # Reset file pointer to beginning
+        image_file.seek(0)
+        image_data = image_file.getvalue()
     
     # Create the data entry
     new_scan = {
@@ -178,44 +710,66 @@ def save_scan_to_history(mode, status, ripeness, diseases, image_file=None):
         "status": status,
         "ripeness": ripeness if ripeness else "N/A",
         "diseases": [d['name'].replace('-', ' ').title() for d in diseases] if diseases else [],
-        "image_path": image_path,
-        "scan_id": f"{username}_{datetime.now().strftime('%Y%m%d%H%M%S')}_{os.urandom(4).hex()}"
+        "image_path": None,
+        "image_key": None,
+        "model_versions": model_versions or {},
+        "degraded": degraded or [],
+        "scan_id": f"{username}_{datetime.now().strftime('%Y%m%d%H%M%S')}_{os.urandom(4).hex()}",
+        "detections_path": None,
+        "annotated_path": None
     }
     
-    # Load existing history from file
-    history = []
-    if os.path.exists(history_file):
-        try:
-            with open(history_file, 'r') as f:
-                history = json.load(f)
-        except:
-            history = []
-    
-    # Add new scan to the top (limit to last 100 scans per user)
-    history.insert(0, new_scan)
-    
-    # Keep only last 100 scans per user to prevent file from getting too large
-    user_scans = [s for s in history if s.get('username') == username]
-    other_scans = [s for s in history if s.get('username') != username]
-    
-    if len(user_scans) > 100:
-        # Remove old scans and their images
-        for old_scan in user_scans[100:]:
-            if old_scan.get('image_path') and os.path.exists(old_scan['image_path']):
-                try:
-                    os.remove(old_scan['image_path'])
-                except:
-                    pass
-        user_scans = user_scans[:100]
-    
-    # Combine back
-    history = user_scans + other_scans
+    # Compact boxes (and optionally the annotated render) for redrawing later
+    if SAVE_DETECTIONS and detections is not None and image_size is not None:
+        new_scan['detections_path'] = save_scan_detections(new_scan['scan_id'], detections, image_size, model_versions)
+        if SAVE_ANNOTATED_PREVIEW and new_scan['detections_path'] and isinstance(annotated_image, Image.Image):
+            new_scan['annotated_path'] = os.path.splitext(new_scan['detections_path'])[0] + "_annotated.jpg"
+            get_storage_executor().submit(save_annotated_preview, annotated_image.copy(), new_scan['annotated_path'])
     
-    with open(history_file, 'w') as f:
-        json.dump(history, f, indent=4)
+    # Read-modify-write under the lock shared with other sessions and storage jobs
+    with get_history_lock():
+        # Save image if provided (stored once per distinct upload)
+        created = False
+        if image_data is not None:
+            try:
+                new_scan['image_key'], new_scan['image_path'], created = store_blob(image_data)
+            except Exception as e:
+                st.error(f"Error saving image: {e}")
+        
+        # Load existing history from file
+        history = []
+        if os.path.exists(history_file):
+            try:
+                with open(history_file, 'r') as f:
+                    history = json.load(f)
+            except:
+                history = []
+        
+        # Add new scan to the top (limit to last 100 scans per user)
+        history.insert(0, new_scan)
+        
+        # Keep only last 100 scans per user to prevent file from getting too large
+        user_scans = [s for s in history if s.get('username') == username]
+        other_scans = [s for s in history if s.get('username') != username]
+        
+        if len(user_scans) > 100:
+            # Remove old scans and release their images
+            for old_scan in user_scans[100:]:
+                release_blob(old_scan)
+                remove_scan_detections(old_scan)
+            user_scans = user_scans[:100]
+        
+        # Combine back
+        history = user_scans + other_scans
+        
+        write_history(history, history_file)
     
     # Update current session view
     st.session_state.recent_scans = user_scans
+    
+    # Convert a newly stored original in the background (compressed format, size budget)
+    if created:
+        schedule_transcode(new_scan['image_path'])
 
 # =============================================================================
 # AUTHENTICATION CHECK
@@ -672,17 +1226,26 @@ if st.session_state.get('show_recent', False):
                 scan_date = scan.get('date', scan.get('timestamp', 'Unknown date'))
                 scan_id = scan.get('scan_id', '')
                 
-                with st.expander(f"🍅 Scan #{len(st.session_state.recent_scans) - idx} - {scan_date}"):
+                with st.expander(f"🍅 Scan #{len(st.session_state.recent_scans) - idx} - {scan_date}",
+                                 expanded=st.session_state.get('open_scan') == scan_id):
                     col1, col2 = st.columns([1, 2])
                     
                     with col1:
-                        # Show saved image if available
-                        img_path = scan.get('image_path')
-                        if img_path and os.path.exists(img_path):
+                        # Show the thumbnail; larger versions only on request
+                        thumb_path = scan_display_image(scan, 'thumb')
+                        if thumb_path:
                             try:
-                                st.image(img_path, caption="Scanned Image", use_column_width=True)
+                                st.image(thumb_path, caption="Scanned Image", use_column_width=True)
                             except:
                                 st.write("📷 Image not available")
+                            if st.session_state.get('open_scan') == scan_id:
+                                if st.button("✖ Hide image", key=f"hide_{scan_id}", use_container_width=True):
+                                    st.session_state.open_scan = None
+                                    st.session_state.download_scan = None
+                                    st.rerun()
+                            elif st.button("🔍 View image", key=f"open_{scan_id}", use_container_width=True):
+                                st.session_state.open_scan = scan_id
+                                st.rerun()
                         else:
                             st.write("📷 No image saved")
                     
@@ -694,6 +1257,9 @@ if st.session_state.get('show_recent', False):
                         if scan.get('ripeness') and scan['ripeness'] != "N/A":
                             st.write(f"**Ripeness:** {scan['ripeness']}")
                         
+                        if scan.get('degraded'):
+                            st.write(f"**Degraded:** {', '.join(scan['degraded'])}")
+                        
                         if scan.get('diseases') and len(scan['diseases']) > 0:
                             st.write(f"**Diseases Detected:**")
                             for disease in scan['diseases']:
@@ -711,6 +1277,35 @@ if st.session_state.get('show_recent', False):
                                 st.rerun()
                             else:
                                 st.error("❌ Failed to delete scan")
+                    
+                    # Opened scan: medium preview with its boxes, original only as a download
+                    if st.session_state.get('open_scan') == scan_id and thumb_path:
+                        preview_path = scan_display_image(scan, 'preview')
+                        annotated_path = scan.get('annotated_path')
+                        saved = load_scan_detections(scan['detections_path']) if scan.get('detections_path') else None
+                        if annotated_path and os.path.exists(annotated_path):
+                            st.image(annotated_path, caption="AI Detection Result", use_column_width=True)
+                        elif saved is not None and preview_path:
+                            st.image(render_scan_detections(preview_path, saved), caption="AI Detection Result", use_column_width=True)
+                        elif preview_path:
+                            st.image(preview_path, use_column_width=True)
+                        if saved is not None:
+                            versions = ", ".join(f"{key}: {version}" for key, version in saved['model_versions'].items())
+                            st.caption(f"{len(saved['conf'])} detection(s)" + (f" | models: {versions}" if versions else ""))
+                        # The original is only read after an explicit request
+                        if st.session_state.get('download_scan') != scan_id:
+                            if st.button("📦 Prepare download", key=f"prepare_{scan_id}", use_container_width=True):
+                                st.session_state.download_scan = scan_id
+                                st.rerun()
+                        else:
+                            try:
+                                with open(scan['image_path'], "rb") as f:
+                                    original_data = f.read()
+                                st.download_button("⬇️ Download original", original_data,
+                                                   file_name=os.path.basename(scan['image_path']),
+                                                   key=f"download_{scan_id}", use_container_width=True)
+                            except:
+                                st.write("📷 Original not available")
         
         if st.button("✖ Close", key="close_recent"):
             st.session_state.show_recent = False
@@ -783,12 +1378,37 @@ with col2:
     
     st.markdown('<p style="text-align: center; margin-top: 20px; font-weight: 600;">📁 Or Upload Image</p>', unsafe_allow_html=True)
     
+    # Batch Mode: analyze many uploads at once (e.g. a whole greenhouse row)
+    batch_mode = st.toggle("📚 Batch Mode (multiple images)", key="batch_mode")
+    # Video Mode: walk-through clips of a greenhouse row
+    video_mode = st.toggle("🎬 Video Mode (walk-through clip)", key="video_mode")
+    
     # UPDATED: Added more file types (webp, bmp, tiff, jfif)
-    uploaded_file = st.file_uploader(
-        "Choose an image...", 
-        type=["jpg", "jpeg", "png", "webp", "bmp", "tiff", "jfif"], 
-        label_visibility="collapsed"
-    )
+    uploaded_files = []
+    uploaded_video = None
+    if video_mode:
+        uploaded_file = None
+        uploaded_video = st.file_uploader(
+            "Choose a video...", 
+            type=["mp4", "mov", "avi", "mkv", "webm"], 
+            key="video_uploader",
+            label_visibility="collapsed"
+        )
+    elif batch_mode:
+        uploaded_file = None
+        uploaded_files = st.file_uploader(
+            "Choose images...", 
+            type=["jpg", "jpeg", "png", "webp", "bmp", "tiff", "jfif"], 
+            accept_multiple_files=True,
+            key="batch_uploader",
+            label_visibility="collapsed"
+        ) or []
+    else:
+        uploaded_file = st.file_uploader(
+            "Choose an image...", 
+            type=["jpg", "jpeg", "png", "webp", "bmp", "tiff", "jfif"], 
+            label_visibility="collapsed"
+        )
 
 # =============================================================================
 # MODE SELECTION RADIO BUTTON
@@ -828,114 +1448,1818 @@ with col_center2:
 # =============================================================================
 # MODEL LOADING (WITH CACHING & ERROR HANDLING)
 # =============================================================================
-@st.cache_resource
-def load_models():
-    """Load all 3 models into a central dictionary"""
-    loaded_models = {}
-    with st.sidebar:
-        with st.status("🚀 Initializing AI Pipeline...", expanded=False) as status:
-            try:
-                # 1. Gatekeeper: Determines if image is Fruit, Leaf, or Invalid (used in auto-detect)
-                loaded_models['gatekeeper'] = YOLO("Classifier.pt")
-                
-                # 2. Fruit Expert: Detection model for ripeness and diseases
-                loaded_models['fruit_expert'] = YOLO("TomatoRipenessDiseasesPro.pt")
-                
-                # 3. Leaf Expert: Leaf detection and disease model
-                loaded_models['leaf_expert'] = YOLO("TomatoLeavesDiseases.pt")
-                
-                st.write("✅ All 3 Models Loaded Successfully")
-            except Exception as e:
-                st.error(f"❌ Initialization Error: {str(e)}")
-            status.update(label="🤖 Pipeline Ready", state="complete", expanded=False)
-    return loaded_models
+# Weights file and YOLO task for each model
+MODEL_FILES = {
+    # 1. Gatekeeper: Determines if image is Fruit, Leaf, or Invalid (used in auto-detect)
+    'gatekeeper': ("Classifier.pt", "classify"),
+    # 2. Fruit Expert: Detection model for ripeness and diseases
+    'fruit_expert': ("TomatoRipenessDiseasesPro.pt", "detect"),
+    # 3. Leaf Expert: Leaf detection and disease model
+    'leaf_expert': ("TomatoLeavesDiseases.pt", "detect"),
+}
 
-models = load_models()
+# Where Ultralytics writes each exported format, next to the weights
+BACKEND_ARTIFACTS = {
+    "onnx": "{stem}.onnx",
+    "openvino": "{stem}_openvino_model",
+}
+
+def backend_artifact_path(weights, backend):
+    """Path of the exported model for a backend (None for plain torch)"""
+    if backend not in BACKEND_ARTIFACTS:
+        return None
+    stem = os.path.splitext(weights)[0]
+    return BACKEND_ARTIFACTS[backend].format(stem=stem)
+
+def export_backend_artifact(weights, backend):
+    """Export weights for a backend once and return the cached artifact path"""
+    artifact = backend_artifact_path(weights, backend)
+    if not os.path.exists(artifact) or os.path.getmtime(artifact) < os.path.getmtime(weights):
+        print(f"Exporting {weights} to {backend}...")
+        # Dynamic axes so batched calls and other input sizes keep working
+        artifact = YOLO(weights).export(format=backend, dynamic=True)
+    return artifact
+
+def load_backend_model(weights, task, backend=None):
+    """
+    Load a model for the configured inference backend
+    
+    The first time a backend is used the weights are exported once and the
+    artifact is cached next to them; it is exported again when the .pt file
+    is newer. Exported models are loaded through YOLO too, so predict returns
+    the same Results objects (same class names, same boxes) on every backend.
+    
+    Args:
+        weights: Path to the .pt weights
+        task: 'detect' or 'classify'
+        backend: 'torch', 'onnx' or 'openvino' (defaults to INFERENCE_BACKEND)
+    
+    Returns:
+        tuple: (YOLO model, backend actually used)
+    """
+    backend = backend or INFERENCE_BACKEND
+    artifact = backend_artifact_path(weights, backend)
+    if artifact is None:
+        return YOLO(weights), "torch"
+    
+    try:
+        artifact = export_backend_artifact(weights, backend)
+        return inference_worker.load_model(artifact, task, cpu_layout['intra_op']), backend
+    except Exception as e:
+        print(f"{backend} backend unavailable for {weights}, using torch: {e}")
+        return YOLO(weights), "torch"
 
 # =============================================================================
-# DETECTION FUNCTIONS
+# INT8 QUANTIZATION (Optional, with accuracy guardrail)
 # =============================================================================
-def draw_boxes(image, results, detection_mode, model):
-    img_pil = Image.fromarray(image) if isinstance(image, np.ndarray) else image.copy()
-    draw = ImageDraw.Draw(img_pil)
-    
-    for result in results:
-        for box in result.boxes:
-            conf = float(box.conf[0])
-            if conf > 0.4:
-                x1, y1, x2, y2 = box.xyxy[0].cpu().numpy().astype(int)
-                cls = int(box.cls[0])
-                name = model.names[cls]
-                color = "#4CAF50" if name.lower() == "healthy" or name == "ripe" else "#F44336"
-                draw.rectangle([x1, y1, x2, y2], outline=color, width=4)
-                draw.text((x1, y1-20), f"{name} {conf:.1%}", fill=color)
-    return img_pil
+def load_calibration_images(folder=None):
+    """Read the sample images used for INT8 calibration and checking (BGR)"""
+    folder = folder or QUANT_CALIBRATION_DIR
+    images = []
+    if os.path.isdir(folder):
+        for filename in sorted(os.listdir(folder)):
+            if filename.lower().endswith((".jpg", ".jpeg", ".png", ".webp", ".bmp", ".tiff", ".jfif")):
+                image = cv2.imread(os.path.join(folder, filename))
+                if image is not None:
+                    images.append(image)
+    return images
 
-def process(image_file, detection_mode):
-    """Process image with the appropriate model based on detection mode"""
-    # Select the appropriate model
-    if detection_mode == "Tomato Fruit":
-        model = models.get('fruit')
-        if model is None:
-            st.error("❌ Fruit detection model not loaded.")
-            return None, None
-    else:  # Tomato Leaf
-        model = models.get('leaf')
-        if model is None:
-            st.error("❌ Leaf disease detection model not loaded.")
-            return None, None
-    
-    image_bytes = image_file.read()
-    nparr = np.frombuffer(image_bytes, np.uint8)
-    image_cv = cv2.imdecode(nparr, cv2.COLOR_BGR2RGB)
+def calibration_tensor(image, task):
+    """Preprocess one BGR image the way YOLO does before the forward pass"""
+    if task == "classify":
+        # Resize the short side and center crop
+        imgsz = GATEKEEPER_IMGSZ
+        height, width = image.shape[:2]
+        scale = imgsz / min(height, width)
+        resized = cv2.resize(image, (max(imgsz, round(width * scale)), max(imgsz, round(height * scale))))
+        top = (resized.shape[0] - imgsz) // 2
+        left = (resized.shape[1] - imgsz) // 2
+        canvas = resized[top:top + imgsz, left:left + imgsz]
+    else:
+        # Letterbox to a square input with gray padding
+        imgsz = DETECT_IMGSZ
+        height, width = image.shape[:2]
+        scale = imgsz / max(height, width)
+        new_w, new_h = round(width * scale), round(height * scale)
+        canvas = np.full((imgsz, imgsz, 3), 114, dtype=np.uint8)
+        top, left = (imgsz - new_h) // 2, (imgsz - new_w) // 2
+        canvas[top:top + new_h, left:left + new_w] = cv2.resize(image, (new_w, new_h))
+    rgb = canvas[:, :, ::-1].transpose(2, 0, 1)
+    return np.ascontiguousarray(rgb, dtype=np.float32)[None] / 255.0
+
+def quantize_onnx(float_path, int8_path, task, calibration_images):
+    """Write an INT8 copy of an ONNX model (static or dynamic PTQ)"""
+    import onnx
+    from onnxruntime import InferenceSession
+    from onnxruntime.quantization import CalibrationDataReader, QuantType, quantize_dynamic, quantize_static
     
-    mode_text = "tomato fruit ripeness & diseases" if detection_mode == "Tomato Fruit" else "tomato leaf diseases"
-    with st.spinner(f"🔍 Analyzing {mode_text}..."):
-        results = model.predict(source=image_cv, conf=0.5)
+    if QUANT_METHOD == "dynamic":
+        quantize_dynamic(float_path, int8_path, weight_type=QuantType.QUInt8)
+    else:
+        input_name = InferenceSession(float_path, providers=["CPUExecutionProvider"]).get_inputs()[0].name
+        
+        class FolderReader(CalibrationDataReader):
+            def __init__(self):
+                self.batches = iter([{input_name: calibration_tensor(image, task)} for image in calibration_images])
+            
+            def get_next(self):
+                return next(self.batches, None)
+        
+        quantize_static(float_path, int8_path, FolderReader(),
+                        activation_type=QuantType.QUInt8, weight_type=QuantType.QInt8)
     
-    output = draw_boxes(image_cv, results, detection_mode, model)
-    return output, results
+    # Keep the YOLO metadata (class names, stride, task) so YOLO can load it
+    float_model = onnx.load(float_path)
+    int8_model = onnx.load(int8_path)
+    del int8_model.metadata_props[:]
+    int8_model.metadata_props.extend(float_model.metadata_props)
+    onnx.save(int8_model, int8_path)
 
-def draw_classification_result(image, result, model):
+def prediction_signature(result, model):
+    """Class label -> best confidence for one result (classification: top-1 only)"""
+    if getattr(result, 'probs', None) is not None:
+        return {model.names[int(result.probs.top1)]: float(result.probs.top1conf)}
+    signature = {}
+    for conf, cls in zip(result.boxes.conf.tolist(), result.boxes.cls.tolist()):
+        name = model.names[int(cls)]
+        signature[name] = max(signature.get(name, 0.0), conf)
+    return signature
+
+def quantization_disagreement(float_model, int8_model, images):
+    """Fraction of images where the INT8 labels or confidences drift from float"""
+    disagreements = 0
+    for image in images:
+        expected = prediction_signature(float_model.predict(image, conf=0.25, verbose=False)[0], float_model)
+        actual = prediction_signature(int8_model.predict(image, conf=0.25, verbose=False)[0], int8_model)
+        if set(expected) != set(actual) or any(abs(expected[name] - actual[name]) > QUANT_CONF_TOLERANCE for name in expected):
+            disagreements += 1
+    return disagreements / len(images)
+
+def int8_artifact_path(weights):
+    return os.path.splitext(weights)[0] + f"_int8_{QUANT_METHOD}.onnx"
+
+def load_int8_model(weights, task, float_model):
     """
-    Visualize CLASSIFICATION results (not detection boxes)
+    Build (once) and check the INT8 variant of a model
     
-    Args:
-        image: Input image (numpy array from OpenCV)
-        result: YOLO classification result with .probs attribute
-        model: The classification model (for class names)
+    The INT8 model is only returned when it agrees with the float model on
+    the calibration images; otherwise the float model stays active.
     
     Returns:
-        PIL Image with classification overlay showing:
-        - Colored border (green for healthy, red for diseased)
-        - Top prediction with confidence
-        - Semi-transparent header bar
+        tuple: (model or None, status text for the sidebar)
     """
-    # Convert OpenCV image (BGR) to PIL (RGB)
-    if isinstance(image, np.ndarray):
-        img_pil = Image.fromarray(cv2.cvtColor(image, cv2.COLOR_BGR2RGB))
+    images = load_calibration_images()
+    if not images:
+        return None, f"no calibration images in '{QUANT_CALIBRATION_DIR}'"
+    
+    float_path = export_backend_artifact(weights, "onnx")
+    int8_path = int8_artifact_path(weights)
+    if not os.path.exists(int8_path) or os.path.getmtime(int8_path) < os.path.getmtime(float_path):
+        print(f"Quantizing {weights} to INT8 ({QUANT_METHOD}) with {len(images)} calibration image(s)...")
+        quantize_onnx(float_path, int8_path, task, images)
+    
+    int8_model = inference_worker.load_model(int8_path, task, cpu_layout['intra_op'])
+    disagreement = quantization_disagreement(float_model, int8_model, images)
+    if disagreement > QUANT_MAX_DISAGREEMENT:
+        print(f"INT8 {weights} rejected: {disagreement:.1%} disagreement")
+        return None, f"int8 rejected ({disagreement:.1%} disagreement)"
+    return int8_model, f"int8 ({disagreement:.1%} disagreement)"
+
+# =============================================================================
+# MODEL WARMUP (First-request latency)
+# =============================================================================
+@st.cache_resource
+def get_model_status():
+    """Per-model load details (backend, warmup and steady-state latency)"""
+    return {}
+
+def warmup_shapes(task):
+    """Input sizes and batch sizes each model will see once serving"""
+    if task == "classify":
+        sizes = [GATEKEEPER_IMGSZ]
     else:
-        img_pil = image.copy()
+        sizes = [DETECT_IMGSZ]
+        if ADAPTIVE_RESOLUTION:
+            sizes.append(LOW_RES_IMGSZ)
+    batches = {1}
+    if MICROBATCH_ENABLED and MICROBATCH_MAX_BATCH > 1:
+        batches.add(MICROBATCH_MAX_BATCH)
+    if task == "detect":
+        # Batch Mode chunks (always available) and the largest tile batch
+        # (all tiles plus the whole image); with micro-batching the tiles
+        # are grouped by the scheduler instead
+        if BATCH_SIZE > 1:
+            batches.add(BATCH_SIZE)
+        if TILED_INFERENCE and not MICROBATCH_ENABLED:
+            batches.add(MAX_TILES + 1)
+    return [(imgsz, batch) for imgsz in sizes for batch in sorted(batches)]
+
+def warmup_model(model, task):
+    """
+    Run a model on synthetic images so graph setup, memory allocation and
+    layer fusion happen now instead of on the first user request
     
-    # Verify this is a classification result
-    if not hasattr(result, 'probs') or result.probs is None:
-        # Fallback: just return the image with an error message
-        draw = ImageDraw.Draw(img_pil)
-        draw.text((10, 10), "Classification Error", fill='red')
-        return img_pil
+    Returns:
+        dict: warmup_ms (all first calls) and steady_ms (median single image)
+    """
+    rng = np.random.default_rng(0)
+    shapes = warmup_shapes(task)
     
-    # Get classification results
-    probs = result.probs
-    top_idx = int(probs.top1)
-    top_conf = float(probs.top1conf)
-    top_name = model.names[top_idx]
+    start = time.perf_counter()
+    for imgsz, batch in shapes:
+        images = [rng.integers(0, 255, (imgsz, imgsz, 3), dtype=np.uint8) for _ in range(batch)]
+        model.predict(images if batch > 1 else images[0], imgsz=imgsz, batch=batch, verbose=False)
+    warmup_ms = (time.perf_counter() - start) * 1000
     
-    # Get image dimensions
-    width, height = img_pil.size
+    imgsz = shapes[0][0]
+    image = rng.integers(0, 255, (imgsz, imgsz, 3), dtype=np.uint8)
+    latencies = []
+    for _ in range(max(1, WARMUP_RUNS)):
+        run_start = time.perf_counter()
+        model.predict(image, imgsz=imgsz, verbose=False)
+        latencies.append((time.perf_counter() - run_start) * 1000)
+    return {'warmup_ms': warmup_ms, 'steady_ms': float(np.median(latencies))}
+
+def load_model(model_key, weights=None):
+    """
+    Load one model: backend export, optional INT8 variant, warmup and pool
     
-    # Determine color based on health status
-    healthy_labels = [
-        "tomato-healthy", "healthy","tomato_leaf", "tomato_healthy", "tomato healthy",
+    Args:
+        model_key: Key in MODEL_FILES
+        weights: Weights file to load (defaults to the file in MODEL_FILES)
+    
+    Returns:
+        tuple: (ModelPool or RemoteModel, details dict for the sidebar)
+    """
+    default_weights, task = MODEL_FILES[model_key]
+    weights = weights or default_weights
+    start = time.perf_counter()
+    model, backend = load_backend_model(weights, task)
+    source = backend_artifact_path(weights, backend) or weights
+    
+    # Swap in the INT8 variant only if it passes the accuracy check
+    if model_key in INT8_MODELS:
+        try:
+            int8_model, int8_status = load_int8_model(weights, task, model)
+        except Exception as e:
+            int8_model, int8_status = None, f"int8 failed ({e})"
+        if int8_model is not None:
+            model = int8_model
+            source = int8_artifact_path(weights)
+        backend += f" / {int8_status}"
+    
+    # Out-of-process mode: the workers load the exported file themselves
+    if WORKER_PROCESSES > 0 and task == "detect":
+        del model
+        pool = InferenceWorkerPool(source, task, WORKER_PROCESSES)
+        details = {'backend': backend + " / workers", 'source': source, 'load_ms': (time.perf_counter() - start) * 1000, 'instances': WORKER_PROCESSES}
+        return RemoteModel(pool, task), details
+    
+    # Extra instances load the already exported file, each with its own predictor
+    instances = [model]
+    for _ in range(MODEL_POOL_SIZES.get(model_key, MODEL_POOL_SIZE) - 1):
+        instances.append(inference_worker.load_model(source, task, cpu_layout['intra_op']))
+    details = {'backend': backend, 'source': source, 'load_ms': (time.perf_counter() - start) * 1000, 'instances': len(instances)}
+    
+    # Warm up before the model serves its first request
+    if WARMUP_ENABLED:
+        try:
+            details.update(warmup_model(model, task))
+            for instance in instances[1:]:
+                warmup_model(instance, task)
+        except Exception as e:
+            print(f"{model_key}: warmup failed ({e})")
+    return ModelPool(instances), details
+
+class ModelPool:
+    """
+    A fixed set of interchangeable instances of one model
+    
+    Ultralytics predictors keep per-call state, so one YOLO object must not
+    run two predicts at once. Each predict checks out an idle instance and
+    returns it afterwards; with N instances N sessions run truly in
+    parallel and the rest wait in line. The pool has the same names and
+    predict() as a YOLO model, so callers use it the same way.
+    """
+    
+    def __init__(self, instances):
+        self.instances = instances
+        self.names = instances[0].names
+        self.task = instances[0].task
+        self.idle = queue.Queue()
+        for instance in instances:
+            self.idle.put(instance)
+        self.lock = threading.Lock()
+        self.created = time.perf_counter()
+        self.checkouts = 0
+        self.waits = 0
+        self.wait_ms = 0.0
+        self.max_wait_ms = 0.0
+        self.busy_ms = 0.0
+    
+    @contextmanager
+    def checkout(self):
+        """Borrow an idle instance for the duration of the with-block"""
+        start = time.perf_counter()
+        try:
+            instance = self.idle.get_nowait()
+            waited = False
+        except queue.Empty:
+            instance = self.idle.get()
+            waited = True
+        checked_out = time.perf_counter()
+        wait_ms = (checked_out - start) * 1000
+        with self.lock:
+            self.checkouts += 1
+            if waited:
+                self.waits += 1
+                self.wait_ms += wait_ms
+                self.max_wait_ms = max(self.max_wait_ms, wait_ms)
+        try:
+            yield instance
+        finally:
+            with self.lock:
+                self.busy_ms += (time.perf_counter() - checked_out) * 1000
+            self.idle.put(instance)
+    
+    def predict(self, *args, **kwargs):
+        with self.checkout() as instance:
+            return instance.predict(*args, **kwargs)
+    
+    def stats(self):
+        """Pool size, current use, waits and utilization for the sidebar"""
+        with self.lock:
+            elapsed_ms = (time.perf_counter() - self.created) * 1000
+            return {
+                'size': len(self.instances),
+                'busy': len(self.instances) - self.idle.qsize(),
+                'checkouts': self.checkouts,
+                'waits': self.waits,
+                'avg_wait_ms': self.wait_ms / self.waits if self.waits else 0.0,
+                'max_wait_ms': self.max_wait_ms,
+                'utilization': self.busy_ms / (elapsed_ms * len(self.instances)) if elapsed_ms else 0.0
+            }
+
+# =============================================================================
+# OUT-OF-PROCESS INFERENCE WORKERS (Optional, WORKER_PROCESSES > 0)
+# =============================================================================
+class InferenceWorkerPool:
+    """
+    Worker processes that each hold one model version
+    
+    Images are written to shared memory and only the block names travel to
+    the worker; results come back as compact (x1, y1, x2, y2, conf, cls)
+    arrays. Workers are replaced after WORKER_MAX_TASKS tasks, the whole
+    pool is recycled when a worker grows past WORKER_MAX_RSS_MB, and a
+    crashed worker only costs a pool restart instead of the web process.
+    
+    Requests pinned to this version hold it with acquire()/release(); a
+    pool replaced by a hot swap is retired and only shut down once the last
+    of them has let go.
+    """
+    
+    def __init__(self, source, task, processes):
+        self.source = source
+        self.task = task
+        self.processes = processes
+        self.lock = threading.Lock()
+        self.created = time.perf_counter()
+        self.in_flight = 0
+        self.checkouts = 0
+        self.waits = 0
+        self.wait_ms = 0.0
+        self.max_wait_ms = 0.0
+        self.busy_ms = 0.0
+        self.recycles = 0
+        self.users = 0
+        self.retired = False
+        self.executor = self._start()
+        self.names = self.executor.submit(inference_worker.model_names).result()
+    
+    def _start(self):
+        return ProcessPoolExecutor(
+            max_workers=self.processes,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=inference_worker.init_worker,
+            initargs=(
+                self.source, self.task, DETECT_IMGSZ if WARMUP_ENABLED else None,
+                cpu_layout['intra_op'], cpu_layout['inter_op'], cpu_layout['cv2'],
+                cpu_layout['core_sets'] if cpu_layout['pin'] else None, cpu_layout['next_slot']
+            ),
+            max_tasks_per_child=WORKER_MAX_TASKS or None
+        )
+    
+    def recycle(self, executor=None):
+        """
+        Start fresh workers; the old ones finish their queued tasks and exit
+        
+        With executor given, only recycle if it is still the current one, so
+        concurrent requests that saw the same crash restart the pool once.
+        """
+        with self.lock:
+            if executor is not None and executor is not self.executor:
+                return
+            old, self.executor = self.executor, self._start()
+            self.recycles += 1
+        old.shutdown(wait=False)
+    
+    def acquire(self):
+        with self.lock:
+            self.users += 1
+    
+    def release(self):
+        with self.lock:
+            self.users -= 1
+            shutdown = self.retired and self.users == 0
+        if shutdown:
+            self.executor.shutdown(wait=False)
+    
+    def retire(self):
+        """Shut down once no pinned request uses this version any more"""
+        with self.lock:
+            self.retired = True
+            shutdown = self.users == 0
+        if shutdown:
+            self.executor.shutdown(wait=False)
+    
+    def run(self, images, predict_args):
+        """Run the model on a list of images, returns one boxes array per image"""
+        blocks = []
+        frames = []
+        with self.lock:
+            self.checkouts += 1
+            waited = self.in_flight >= self.processes
+            self.in_flight += 1
+        start = time.perf_counter()
+        run_ms = 0.0
+        try:
+            for image in images:
+                block = shared_memory.SharedMemory(create=True, size=max(1, image.nbytes))
+                np.ndarray(image.shape, dtype=image.dtype, buffer=block.buf)[...] = image
+                blocks.append(block)
+                frames.append((block.name, image.shape, image.dtype.str))
+            
+            for attempt in range(2):
+                executor = self.executor
+                try:
+                    boxes, rss, run_ms = executor.submit(inference_worker.run_inference, frames, predict_args).result()
+                    break
+                except BrokenProcessPool:
+                    print(f"Inference worker for {self.source} crashed, restarting workers")
+                    self.recycle(executor)
+                    if attempt:
+                        raise
+                except RuntimeError:
+                    # Recycled by another request between reading and submitting:
+                    # retry on the current workers
+                    if attempt or executor is self.executor:
+                        raise
+        finally:
+            for block in blocks:
+                block.close()
+                block.unlink()
+            elapsed_ms = (time.perf_counter() - start) * 1000
+            with self.lock:
+                self.in_flight -= 1
+                self.busy_ms += elapsed_ms
+                if waited:
+                    # Queueing behind busy workers = round trip minus time spent in the worker
+                    wait_ms = max(0.0, elapsed_ms - run_ms)
+                    self.waits += 1
+                    self.wait_ms += wait_ms
+                    self.max_wait_ms = max(self.max_wait_ms, wait_ms)
+        
+        if rss > WORKER_MAX_RSS_MB * 1024 * 1024:
+            print(f"Inference worker for {self.source} uses {rss / 1024 / 1024:.0f} MB, recycling workers")
+            self.recycle()
+        return boxes
+    
+    def stats(self):
+        """Same fields as ModelPool.stats plus the number of recycles"""
+        with self.lock:
+            elapsed_ms = (time.perf_counter() - self.created) * 1000
+            return {
+                'size': self.processes,
+                'busy': min(self.in_flight, self.processes),
+                'checkouts': self.checkouts,
+                'waits': self.waits,
+                'avg_wait_ms': self.wait_ms / self.waits if self.waits else 0.0,
+                'max_wait_ms': self.max_wait_ms,
+                'utilization': min(1.0, self.busy_ms / (elapsed_ms * self.processes)) if elapsed_ms else 0.0,
+                'recycles': self.recycles
+            }
+
+class RemoteModel:
+    """Stand-in for a YOLO model whose predict runs in the worker processes"""
+    
+    def __init__(self, pool, task):
+        self.pool = pool
+        self.task = task
+        self.names = pool.names
+    
+    def predict(self, source, verbose=False, batch=None, **predict_args):
+        images = source if isinstance(source, list) else [source]
+        boxes = self.pool.run(images, predict_args)
+        return [
+            Results(orig_img=image, path="", names=self.names, boxes=torch.from_numpy(data))
+            for image, data in zip(images, boxes)
+        ]
+    
+    def stats(self):
+        return self.pool.stats()
+
+def describe_model(model_key, details):
+    """One status line for a loaded model"""
+    text = f"{model_key} {details.get('version', 'base')}: {details['backend']} x{details.get('instances', 1)}, loaded in {details['load_ms']:.0f} ms"
+    if 'steady_ms' in details:
+        text += f", warmup {details['warmup_ms']:.0f} ms, steady {details['steady_ms']:.0f} ms"
+    return text
+
+def parse_model_version(filename, stem):
+    """Version tuple of '<stem>_v<version>.pt' (e.g. _v3 or _v1.2), None if it doesn't match"""
+    match = re.fullmatch(re.escape(stem) + r"_v(\d+(?:\.\d+)*)\.pt", filename)
+    if not match:
+        return None
+    return tuple(int(part) for part in match.group(1).split("."))
+
+def latest_model_weights(model_key):
+    """
+    Newest versioned weights for a model in MODELS_DIR
+    
+    Returns:
+        tuple: (weights path, version label) - the base file in MODEL_FILES
+        with version 'base' when MODELS_DIR has no versions of it
+    """
+    default_weights = MODEL_FILES[model_key][0]
+    stem = os.path.splitext(os.path.basename(default_weights))[0]
+    best = None
+    if os.path.isdir(MODELS_DIR):
+        for filename in os.listdir(MODELS_DIR):
+            version = parse_model_version(filename, stem)
+            if version is not None and (best is None or version > best[0]):
+                best = (version, filename)
+    if best is None:
+        return default_weights, "base"
+    return os.path.join(MODELS_DIR, best[1]), "v" + ".".join(str(part) for part in best[0])
+
+class ModelRegistry:
+    """
+    Dictionary-like access to the active version of each model
+    
+    models['fruit_expert'] loads the newest version of the fruit expert the
+    first time it is needed; a per-model lock makes sure concurrent sessions
+    load it once. `key in models` tells whether a model is configured, not
+    whether it is loaded yet.
+    
+    New versions dropped into MODELS_DIR are loaded and warmed up in the
+    background, then swapped in atomically. Requests should work on
+    models.pin() so they finish on the version they started with.
+    """
+    
+    def __init__(self):
+        self.models = {}
+        self.versions = {}
+        self.locks = {model_key: threading.Lock() for model_key in MODEL_FILES}
+        # (weights, mtime, size) of versions that failed to load
+        self.failed = set()
+    
+    def __getitem__(self, model_key):
+        model = self.models.get(model_key)
+        if model is not None:
+            return model
+        return self.entry(model_key)[0]
+    
+    def entry(self, model_key):
+        """(model, version info) of the active version, loading it if needed"""
+        active = self.models.get(model_key)
+        if active is not None:
+            return active, self.versions[model_key]
+        if model_key not in self.locks:
+            raise KeyError(model_key)
+        with self.locks[model_key]:
+            if model_key not in self.models:
+                weights, version = latest_model_weights(model_key)
+                self._load(model_key, weights, version)
+            return self.models[model_key], self.versions[model_key]
+    
+    def _load(self, model_key, weights, version):
+        print(f"Loading {model_key} {version} from {weights}...")
+        model, details = load_model(model_key, weights)
+        details['version'] = version
+        get_model_status()[model_key] = details
+        print(describe_model(model_key, details))
+        # Swap version info and model together so readers never see a mix
+        self.versions[model_key] = {'version': version, 'weights': weights, 'source': details['source'], 'backend': details['backend']}
+        self.models[model_key] = model
+    
+    def __contains__(self, model_key):
+        return model_key in MODEL_FILES
+    
+    def get(self, model_key, default=None):
+        if model_key not in self:
+            return default
+        return self[model_key]
+    
+    def is_loaded(self, model_key):
+        return model_key in self.models
+    
+    def weights(self, model_key):
+        return self.entry(model_key)[1]['weights']
+    
+    def version(self, model_key):
+        return self.entry(model_key)[1]['version']
+    
+    def runtime(self, model_key):
+        """(loaded file, active backend) - the export or INT8 file when one is used"""
+        info = self.entry(model_key)[1]
+        return info['source'], info['backend']
+    
+    def pin(self):
+        """Per-request view that keeps using the versions it first sees"""
+        return PinnedModels(self)
+    
+    def preload(self, model_keys):
+        """Load models in a background thread so the first user does not wait"""
+        def run():
+            for model_key in model_keys:
+                try:
+                    self[model_key]
+                except Exception as e:
+                    print(f"Preload of {model_key} failed: {e}")
+        threading.Thread(target=run, name="model-preload", daemon=True).start()
+    
+    def check_for_updates(self):
+        """Load, warm up and swap in newer versions of already loaded models"""
+        for model_key in list(self.models):
+            weights, version = latest_model_weights(model_key)
+            if weights == self.versions[model_key]['weights']:
+                continue
+            try:
+                # A file that is still being copied fails to load; once it is
+                # complete its mtime/size change and it is tried again
+                stat = os.stat(weights)
+            except OSError:
+                continue
+            attempt = (weights, stat.st_mtime, stat.st_size)
+            if attempt in self.failed:
+                continue
+            try:
+                # Load outside the lock, the old version keeps serving meanwhile
+                model, details = load_model(model_key, weights)
+            except Exception as e:
+                print(f"Could not load {weights}: {e}")
+                self.failed.add(attempt)
+                continue
+            details['version'] = version
+            with self.locks[model_key]:
+                old = self.models[model_key]
+                get_model_status()[model_key] = details
+                self.versions[model_key] = {'version': version, 'weights': weights, 'source': details['source'], 'backend': details['backend']}
+                self.models[model_key] = model
+            if isinstance(old, RemoteModel):
+                # Requests pinned to the old version keep using its workers;
+                # they exit once the last of those requests is done
+                old.pool.retire()
+            print(f"Swapped {model_key} to {version}")
+    
+    def watch(self, interval):
+        """Poll MODELS_DIR for new versions in a background thread"""
+        def run():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.check_for_updates()
+                except Exception as e:
+                    print(f"Model watcher error: {e}")
+        threading.Thread(target=run, name="model-watcher", daemon=True).start()
+
+class PinnedModels:
+    """
+    The models one request works with
+    
+    Each model is taken from the registry the first time the request uses
+    it and kept for the rest of the request, so a hot swap never mixes two
+    versions (or two sets of class names) inside one analysis. Worker pools
+    are held until release() (or until the view is garbage collected, e.g.
+    when the script run stops early), so a swapped-out pool stays up.
+    """
+    
+    def __init__(self, registry):
+        self.registry = registry
+        self.entries = {}
+        self.pools = []
+        self.release = weakref.finalize(self, PinnedModels._release, self.pools)
+    
+    @staticmethod
+    def _release(pools):
+        while pools:
+            pools.pop().release()
+    
+    def __getitem__(self, model_key):
+        if model_key not in self.entries:
+            model, info = self.registry.entry(model_key)
+            if isinstance(model, RemoteModel) and self.release.alive:
+                model.pool.acquire()
+                self.pools.append(model.pool)
+            self.entries[model_key] = (model, info)
+        return self.entries[model_key][0]
+    
+    def __contains__(self, model_key):
+        return model_key in self.registry
+    
+    def get(self, model_key, default=None):
+        if model_key not in self:
+            return default
+        return self[model_key]
+    
+    def weights(self, model_key):
+        self[model_key]
+        return self.entries[model_key][1]['weights']
+    
+    def version(self, model_key):
+        self[model_key]
+        return self.entries[model_key][1]['version']
+    
+    def runtime(self, model_key):
+        self[model_key]
+        info = self.entries[model_key][1]
+        return info['source'], info['backend']
+    
+    def used_versions(self):
+        """Versions of the models this request actually ran"""
+        return {model_key: info['version'] for model_key, (_, info) in self.entries.items()}
+
+@st.cache_resource
+def load_models():
+    """Create the central model registry (all 3 models, loaded lazily by default)"""
+    loaded_models = ModelRegistry()
+    with st.sidebar:
+        with st.status("🚀 Initializing AI Pipeline...", expanded=False) as status:
+            try:
+                if LAZY_MODEL_LOADING:
+                    st.write("💤 Models load on first use")
+                else:
+                    for model_key in MODEL_FILES:
+                        loaded_models[model_key]
+                        st.write(f"🔥 {describe_model(model_key, get_model_status()[model_key])}")
+                    st.write("✅ All 3 Models Loaded Successfully")
+            except Exception as e:
+                st.error(f"❌ Initialization Error: {str(e)}")
+            status.update(label="🤖 Pipeline Ready", state="complete", expanded=False)
+    return loaded_models
+
+@st.cache_resource
+def start_model_preload(_models):
+    """Start background preloading once per process"""
+    if PRELOAD_MODELS.lower() == "auto":
+        # Both experts are reachable from the mode picker; the gatekeeper is
+        # only ever used when Auto-Detect routes through it
+        model_keys = [key for key in MODEL_FILES if key != 'gatekeeper' or AUTO_DETECT_ROUTING == "gatekeeper"]
+    elif PRELOAD_MODELS.lower() == "all":
+        model_keys = list(MODEL_FILES)
+    else:
+        model_keys = [key.strip() for key in PRELOAD_MODELS.split(",") if key.strip() in MODEL_FILES]
+    if model_keys:
+        _models.preload(model_keys)
+    return model_keys
+
+@st.cache_resource
+def start_model_watcher(_models):
+    """Start watching MODELS_DIR for new versions once per process"""
+    _models.watch(MODEL_WATCH_INTERVAL)
+    return True
+
+# =============================================================================
+# CPU THREAD LAYOUT (Avoid oversubscription between concurrent inferences)
+# =============================================================================
+def parse_core_list(text):
+    """'0-3,8' -> [0, 1, 2, 3, 8]"""
+    cores = []
+    for part in text.split(","):
+        part = part.strip()
+        if "-" in part:
+            first, last = part.split("-")
+            cores.extend(range(int(first), int(last) + 1))
+        elif part:
+            cores.append(int(part))
+    return cores
+
+def plan_cpu_layout():
+    """
+    Split the available cores between the concurrent inference slots
+    
+    Returns:
+        dict: cores, slots, per-slot thread counts and per-slot core sets
+    """
+    if CPU_AFFINITY and CPU_AFFINITY != "auto":
+        cores = parse_core_list(CPU_AFFINITY)
+    elif hasattr(os, "sched_getaffinity"):
+        cores = sorted(os.sched_getaffinity(0))
+    else:
+        cores = list(range(os.cpu_count() or 1))
+    
+    slots = INFERENCE_SLOTS
+    if slots <= 0:
+        if WORKER_PROCESSES > 0:
+            # One worker pool per detection expert
+            slots = WORKER_PROCESSES * 2
+        else:
+            slots = MODEL_POOL_SIZE * (2 if PARALLEL_EXPERTS else 1)
+    slots = max(1, min(slots, len(cores)))
+    
+    per_slot = len(cores) // slots
+    return {
+        'cores': cores,
+        'slots': slots,
+        'intra_op': TORCH_INTRA_OP_THREADS or max(1, per_slot),
+        'inter_op': TORCH_INTER_OP_THREADS or 1,
+        'cv2': CV2_THREADS or 1,
+        'core_sets': [cores[i * per_slot:(i + 1) * per_slot] for i in range(slots)],
+        # "auto" pins worker processes only, in-process models share the cores
+        'pin': bool(CPU_AFFINITY) and (CPU_AFFINITY != "auto" or WORKER_PROCESSES > 0)
+    }
+
+def describe_cpu_layout(layout):
+    text = (f"{len(layout['cores'])} core(s), {layout['slots']} slot(s): "
+            f"torch intra-op {layout['intra_op']}, inter-op {layout['inter_op']}, cv2 {layout['cv2']}")
+    if layout['pin']:
+        text += ", pinned"
+    return text
+
+@st.cache_resource
+def configure_cpu_threads():
+    """Apply the thread layout to this process once at startup"""
+    layout = plan_cpu_layout()
+    if CPU_AFFINITY and CPU_AFFINITY != "auto" and hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, layout['cores'])
+    torch.set_num_threads(layout['intra_op'])
+    try:
+        torch.set_num_interop_threads(layout['inter_op'])
+    except RuntimeError as e:
+        # Only possible before torch has started any parallel work
+        print(f"Could not set inter-op threads: {e}")
+    cv2.setNumThreads(layout['cv2'])
+    # OpenMP/MKL code started later (worker processes) reads these; ONNX Runtime
+    # and OpenVINO ignore them and get intra_op through load_model instead
+    os.environ["OMP_NUM_THREADS"] = str(layout['intra_op'])
+    os.environ["MKL_NUM_THREADS"] = str(layout['intra_op'])
+    
+    print(f"CPU LAYOUT: {describe_cpu_layout(layout)}")
+    for slot, core_set in enumerate(layout['core_sets']):
+        print(f"  slot {slot}: cores {core_set[0]}-{core_set[-1]}" if core_set else f"  slot {slot}: shared")
+    
+    # Worker pools take their core sets from here, one slot per worker
+    layout['next_slot'] = multiprocessing.get_context("spawn").Value('i', 0)
+    return layout
+
+cpu_layout = configure_cpu_threads()
+
+models = load_models()
+
+@st.cache_resource
+def get_expert_executor():
+    """Thread pool shared by all sessions for running experts concurrently"""
+    return ThreadPoolExecutor(max_workers=EXPERT_POOL_WORKERS, thread_name_prefix="expert")
+
+# =============================================================================
+# MICRO-BATCHING SCHEDULER (Shared by all sessions)
+# =============================================================================
+class MicroBatchScheduler:
+    """
+    Groups predict calls from every session into batched forward passes
+    
+    Each model gets a queue and a collector thread. The collector takes the
+    first waiting request, collects more for up to window_ms (or until
+    max_batch requests are waiting) and hands the batch to a runner, which
+    runs one batched predict and gives each caller its own result through a
+    Future. A model gets as many runners as it can run predicts at once
+    (pool instances or worker processes), so MODEL_POOL_SIZE > 1 still
+    runs batches in parallel; while all runners are busy requests keep
+    queueing into the next batch.
+    """
+    
+    def __init__(self, models, window_ms, max_batch):
+        self.models = models
+        self.window = window_ms / 1000
+        self.max_batch = max_batch
+        self.queues = {}
+        self.runners = {}
+        self.lock = threading.Lock()
+        self.batches = 0
+        self.requests = 0
+        self.latencies_ms = deque(maxlen=1000)
+    
+    def submit(self, model_key, image, model=None, **predict_args):
+        """
+        Queue one image for a model, returns a Future with its results list
+        
+        Passing the model object keeps a request on the model version it
+        started with while a new version is being swapped in.
+        """
+        model = model or self.models[model_key]
+        future = Future()
+        with self.lock:
+            if model_key not in self.queues:
+                self.queues[model_key] = queue.Queue()
+                concurrency = self._concurrency(model)
+                self.runners[model_key] = (
+                    ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix=f"microbatch-{model_key}-run"),
+                    threading.Semaphore(concurrency)
+                )
+                threading.Thread(
+                    target=self._worker, args=(model_key,),
+                    name=f"microbatch-{model_key}", daemon=True
+                ).start()
+        self.queues[model_key].put((image, predict_args, future, time.perf_counter(), model))
+        return future
+    
+    def predict(self, model_key, image, model=None, **predict_args):
+        """Blocking version of submit"""
+        return self.submit(model_key, image, model=model, **predict_args).result()
+    
+    @staticmethod
+    def _concurrency(model):
+        """How many predicts a model can run at once"""
+        if isinstance(model, ModelPool):
+            return len(model.instances)
+        if isinstance(model, RemoteModel):
+            return model.pool.processes
+        return 1
+    
+    def _worker(self, model_key):
+        pending = self.queues[model_key]
+        runners, free = self.runners[model_key]
+        while True:
+            # Wait for a free runner first, requests keep queueing meanwhile
+            free.acquire()
+            batch = [pending.get()]
+            deadline = time.perf_counter() + self.window
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(pending.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            
+            # Requests can only share a forward pass if they use the same model
+            # version and the same predict settings
+            groups = {}
+            for request in batch:
+                key = (id(request[4]), tuple(sorted(request[1].items())))
+                groups.setdefault(key, []).append(request)
+            for index, group in enumerate(groups.values()):
+                if index:
+                    free.acquire()
+                runners.submit(self._dispatch, model_key, group, free)
+    
+    def _dispatch(self, model_key, group, free):
+        try:
+            self._run(model_key, group)
+        finally:
+            free.release()
+    
+    def _run(self, model_key, group):
+        images = [request[0] for request in group]
+        try:
+            results = group[0][4].predict(images, batch=len(images), verbose=False, **group[0][1])
+        except Exception as e:
+            for request in group:
+                request[2].set_exception(e)
+            return
+        finished = time.perf_counter()
+        with self.lock:
+            self.batches += 1
+            self.requests += len(group)
+            for request in group:
+                self.latencies_ms.append((finished - request[3]) * 1000)
+        for request, result in zip(group, results):
+            request[2].set_result([result])
+    
+    def stats(self):
+        """Batching and latency numbers for the sidebar"""
+        with self.lock:
+            latencies = sorted(self.latencies_ms)
+            batches = self.batches
+            requests = self.requests
+        p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] if latencies else 0.0
+        return {
+            'batches': batches,
+            'requests': requests,
+            'avg_batch': requests / batches if batches else 0.0,
+            'p99_ms': p99
+        }
+
+@st.cache_resource
+def get_inference_scheduler(_models):
+    """One scheduler for the whole process (the models dict is not hashed)"""
+    return MicroBatchScheduler(_models, MICROBATCH_WINDOW_MS, MICROBATCH_MAX_BATCH)
+
+# =============================================================================
+# PIPELINE STATS (Shared by all sessions)
+# =============================================================================
+class PipelineStats:
+    """Thread-safe counters reported in the sidebar"""
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.averages = {}
+    
+    def increment(self, name, amount=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+    
+    def get(self, name):
+        with self.lock:
+            return self.counters.get(name, 0)
+    
+    def observe(self, name, value, alpha=0.2):
+        """Fold a latency sample into an exponential moving average"""
+        with self.lock:
+            previous = self.averages.get(name)
+            self.averages[name] = value if previous is None else previous + alpha * (value - previous)
+    
+    def estimate(self, name, default=0.0):
+        with self.lock:
+            return self.averages.get(name, default)
+    
+    def decay(self, name, factor=0.8):
+        """Shrink an estimate whose stage was skipped, so it is tried (and re-measured) again"""
+        with self.lock:
+            if name in self.averages:
+                self.averages[name] *= factor
+
+@st.cache_resource
+def get_pipeline_stats():
+    return PipelineStats()
+
+class Deadline:
+    """
+    Latency budget of one analysis request
+    
+    Stages ask fits() with their expected cost (moving averages kept in
+    PipelineStats) and call degrade() when they downgrade or skip work, so
+    the result can be marked and the levels counted. A budget of 0 never
+    degrades anything.
+    """
+    
+    def __init__(self, budget_ms):
+        self.budget_ms = budget_ms
+        self.start = time.perf_counter()
+        self.degraded = []
+        if self.enabled:
+            get_pipeline_stats().increment('deadline_requests')
+    
+    @property
+    def enabled(self):
+        return self.budget_ms > 0
+    
+    def elapsed_ms(self):
+        return (time.perf_counter() - self.start) * 1000
+    
+    def remaining_ms(self):
+        return self.budget_ms - self.elapsed_ms() if self.enabled else float("inf")
+    
+    def fits(self, expected_ms):
+        return self.remaining_ms() >= expected_ms
+    
+    def timeout(self):
+        """Seconds left for a blocking wait (None = wait forever)"""
+        return max(0.0, self.remaining_ms()) / 1000 if self.enabled else None
+    
+    def degrade(self, level):
+        if level not in self.degraded:
+            print(f"DEADLINE: {level} ({self.remaining_ms():.0f} ms left)")
+            self.degraded.append(level)
+            get_pipeline_stats().increment(f"degraded_{level}")
+    
+    def finish(self):
+        """Count the request as a deadline hit if it ran out of budget"""
+        if self.enabled and (self.remaining_ms() <= 0 or "expert_timeout" in self.degraded):
+            get_pipeline_stats().increment('deadline_hits')
+        return self.degraded
+
+def expected_expert_ms(model_keys, imgsz=None, parallel=None):
+    """Expected cost of running experts, from the moving averages of earlier requests"""
+    stats = get_pipeline_stats()
+    costs = []
+    for key in model_keys:
+        full_ms = stats.estimate(f"{key}_ms")
+        if imgsz:
+            # Without a low-resolution sample yet, scale by the pixel count
+            full_ms = stats.estimate(f"{key}_{imgsz}_ms", full_ms * (imgsz / DETECT_IMGSZ) ** 2)
+        costs.append(full_ms)
+    if not costs:
+        return 0.0
+    parallel = PARALLEL_EXPERTS if parallel is None else parallel
+    return max(costs) if parallel else sum(costs)
+
+def plan_experts(deadline, expert_keys):
+    """
+    Downgrade the expert stage to fit the remaining budget
+    
+    Full resolution first, then LOW_RES_IMGSZ (single pass, no tiling),
+    then a single expert at low resolution.
+    
+    Returns:
+        tuple: (expert_keys, imgsz) - imgsz is None for the normal path
+    """
+    if deadline.fits(expected_expert_ms(expert_keys)):
+        return expert_keys, None
+    deadline.degrade("low_resolution")
+    if len(expert_keys) > 1 and not deadline.fits(expected_expert_ms(expert_keys, LOW_RES_IMGSZ)):
+        deadline.degrade("single_expert")
+        stats = get_pipeline_stats()
+        for key in expert_keys[1:]:
+            # The dropped expert is not re-measured, let its estimate recover
+            stats.decay(f"{key}_ms")
+            stats.decay(f"{key}_{LOW_RES_IMGSZ}_ms")
+        expert_keys = expert_keys[:1]
+    return expert_keys, LOW_RES_IMGSZ
+
+def needs_escalation(results):
+    """True when a low-resolution result is empty or not confident enough"""
+    result = results[0]
+    if not hasattr(result, 'boxes') or result.boxes is None or len(result.boxes) == 0:
+        return True
+    return float(result.boxes.conf.max()) < ESCALATION_CONF
+
+def predict_single(models, model_key, image, **predict_args):
+    """Run predict on one image, through the micro-batching scheduler when enabled"""
+    if MICROBATCH_ENABLED:
+        return get_inference_scheduler(load_models()).predict(model_key, image, model=models[model_key], **predict_args)
+    return models[model_key].predict(image, verbose=False, **predict_args)
+
+def needs_tiling(image):
+    """Only photos spanning about two tiles or more are worth slicing"""
+    return max(image.shape[:2]) > TILE_SIZE * (2 - TILE_OVERLAP)
+
+def tile_grid(height, width):
+    """
+    Top-left corners and size of overlapping tiles covering the image
+    
+    The tile grows when the grid would need more than MAX_TILES tiles,
+    so the cost of one image stays bounded.
+    """
+    tile = TILE_SIZE
+    while True:
+        stride = max(1, int(tile * (1 - TILE_OVERLAP)))
+        rows = max(1, int(np.ceil((height - tile) / stride)) + 1) if height > tile else 1
+        cols = max(1, int(np.ceil((width - tile) / stride)) + 1) if width > tile else 1
+        if rows * cols <= MAX_TILES:
+            break
+        tile = int(tile * 1.25)
+    ys = np.linspace(0, max(0, height - tile), rows).astype(int)
+    xs = np.linspace(0, max(0, width - tile), cols).astype(int)
+    return [(int(y), int(x)) for y in ys for x in xs], tile
+
+def predict_tiled(models, model_key, image, **predict_args):
+    """
+    Sliced inference: run overlapping tiles plus the whole image as one batch
+    and merge the boxes in full-image coordinates with class-aware NMS
+    
+    Returns:
+        list: One YOLO Results object, like a normal predict call
+    """
+    height, width = image.shape[:2]
+    corners, tile = tile_grid(height, width)
+    # The whole image is included so large fruit split across tiles is still found
+    crops = [image] + [image[y:y + tile, x:x + tile] for y, x in corners]
+    offsets = [(0, 0)] + corners
+    
+    if MICROBATCH_ENABLED:
+        scheduler = get_inference_scheduler(load_models())
+        futures = [scheduler.submit(model_key, crop, model=models[model_key], **predict_args) for crop in crops]
+        crop_results = [future.result()[0] for future in futures]
+    else:
+        crop_results = models[model_key].predict(crops, batch=len(crops), verbose=False, **predict_args)
+    
+    merged = []
+    for (y, x), result in zip(offsets, crop_results):
+        data = result.boxes.data.clone()
+        if len(data):
+            data[:, [0, 2]] += x
+            data[:, [1, 3]] += y
+            merged.append(data)
+    if merged:
+        data = torch.cat(merged)
+        keep = batched_nms(data[:, :4], data[:, 4], data[:, 5].long(), TILE_NMS_IOU)
+        data = data[keep]
+    else:
+        data = torch.zeros((0, 6))
+    print(f"Tiled {model_key}: {len(crops) - 1} tile(s) of {tile}px, {len(data)} box(es) after NMS")
+    return [Results(orig_img=image, path="", names=models[model_key].names, boxes=data)]
+
+# =============================================================================
+# RESULT CACHE (Shared by all sessions)
+# =============================================================================
+class ResultCache:
+    """
+    LRU cache of compact detection outputs
+    
+    Entries are the boxes array (x1, y1, x2, y2, conf, cls) of one expert on
+    one image, so an Auto-Detect run also answers later Fruit Only / Leaf
+    Only requests for the same image. Old entries are evicted when either
+    the entry count or the byte budget is exceeded.
+    """
+    
+    def __init__(self, max_entries, max_bytes):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+    
+    def get(self, key):
+        with self.lock:
+            value = self.entries.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return value
+    
+    def put(self, key, value):
+        with self.lock:
+            if key in self.entries:
+                self.size -= self.entries.pop(key).nbytes
+            self.entries[key] = value
+            self.size += value.nbytes
+            while self.entries and (len(self.entries) > self.max_entries or self.size > self.max_bytes):
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= evicted.nbytes
+    
+    def stats(self):
+        with self.lock:
+            return {'entries': len(self.entries), 'bytes': self.size, 'hits': self.hits, 'misses': self.misses}
+
+@st.cache_resource
+def get_result_cache():
+    return ResultCache(RESULT_CACHE_MAX_ENTRIES, int(RESULT_CACHE_MAX_MB * 1024 * 1024))
+
+def model_version(models, model_key):
+    """
+    Identify the weights and runtime a model's results came from
+    
+    Keyed on what was actually loaded, not on the configuration: a failed
+    export falls back to PyTorch and a rejected INT8 variant to float, and
+    the loaded file changes when either is rebuilt.
+    """
+    weights = models.weights(model_key)
+    source, backend = models.runtime(model_key)
+    try:
+        stat = os.stat(source)
+        stamp = f"{int(stat.st_mtime)}-{stat.st_size}"
+    except OSError:
+        stamp = "unknown"
+    return f"{weights}:{source}@{stamp}/{backend}"
+
+def result_cache_key(models, model_key, image_hash, predict_args):
+    """Everything that can change an expert's boxes for the same image bytes"""
+    settings = (
+        DETECT_IMGSZ,
+        (ADAPTIVE_RESOLUTION, LOW_RES_IMGSZ, ESCALATION_CONF),
+        (TILED_INFERENCE, TILE_SIZE, TILE_OVERLAP, MAX_TILES, TILE_NMS_IOU),
+    )
+    return (image_hash, model_key, model_version(models, model_key), tuple(sorted(predict_args.items())), settings)
+
+def predict_expert(models, model_key, image, image_hash=None, observe=False, **predict_args):
+    """
+    Run an expert on one image
+    
+    With TILED_INFERENCE large images are cut into overlapping tiles. With
+    ADAPTIVE_RESOLUTION the image is first run at LOW_RES_IMGSZ and only
+    re-run at full resolution when the cheap pass is empty or ambiguous.
+    
+    When image_hash is given, results are looked up in (and stored to) the
+    process-wide result cache so repeated analyses skip inference.
+    
+    With observe, the latency of real inference runs (never cache hits)
+    feeds the estimates the request deadline plans with.
+    
+    Returns:
+        list: YOLO results, same shape as calling model.predict directly
+    """
+    if not (RESULT_CACHE_ENABLED and image_hash):
+        return predict_observed(models, model_key, image, observe, **predict_args)
+    
+    cache = get_result_cache()
+    key = result_cache_key(models, model_key, image_hash, predict_args)
+    boxes = cache.get(key)
+    if boxes is not None:
+        print(f"{model_key}: result cache hit")
+        return [Results(orig_img=image, path="", names=models[model_key].names, boxes=torch.from_numpy(boxes.copy()))]
+    
+    results = predict_observed(models, model_key, image, observe, **predict_args)
+    cache.put(key, results[0].boxes.data.cpu().numpy().astype(np.float32))
+    return results
+
+def predict_observed(models, model_key, image, observe=False, **predict_args):
+    """Run predict_uncached and record its latency when observe is set"""
+    start = time.perf_counter()
+    results = predict_uncached(models, model_key, image, **predict_args)
+    if observe:
+        observe_expert_ms(model_key, predict_args.get('imgsz'), (time.perf_counter() - start) * 1000)
+    return results
+
+def observe_expert_ms(model_key, imgsz, elapsed_ms):
+    """
+    Record an expert run for the deadline estimates
+    
+    A run at a reduced size also refreshes the full-resolution estimate
+    (scaled by the pixel count), otherwise one slow spike would keep every
+    later request degraded without ever measuring full resolution again.
+    """
+    stats = get_pipeline_stats()
+    if imgsz and imgsz != DETECT_IMGSZ:
+        stats.observe(f"{model_key}_{imgsz}_ms", elapsed_ms)
+        stats.observe(f"{model_key}_ms", elapsed_ms * (DETECT_IMGSZ / imgsz) ** 2)
+    else:
+        stats.observe(f"{model_key}_ms", elapsed_ms)
+
+def predict_uncached(models, model_key, image, **predict_args):
+    """Run an expert on one image (tiled / adaptive resolution when enabled)"""
+    # An explicit imgsz asks for one pass at that size
+    if TILED_INFERENCE and needs_tiling(image) and 'imgsz' not in predict_args:
+        return predict_tiled(models, model_key, image, **predict_args)
+    if not ADAPTIVE_RESOLUTION or 'imgsz' in predict_args:
+        return predict_single(models, model_key, image, **predict_args)
+    
+    stats = get_pipeline_stats()
+    stats.increment('adaptive_requests')
+    results = predict_single(models, model_key, image, imgsz=LOW_RES_IMGSZ, **predict_args)
+    if needs_escalation(results):
+        stats.increment('adaptive_escalations')
+        results = predict_single(models, model_key, image, imgsz=DETECT_IMGSZ, **predict_args)
+    return results
+
+# =============================================================================
+# IMAGE INGESTION (Read and decode each upload once)
+# =============================================================================
+class IngestedImage:
+    """
+    One uploaded image, read and decoded exactly once per request
+    
+    - data: the uploaded bytes (hashed for the result cache, saved to history)
+    - bgr: decoded (H, W, 3) uint8 array every model reads, possibly at a
+      reduced resolution (see decode_bytes)
+    - rgb: the same pixels with channels reversed - a view, not a copy
+    - digest: SHA-256 of data, computed on first use
+    - original_size: (width, height) of the upload before any reduction
+    """
+    
+    def __init__(self, data, bgr, decode_ms=0.0, original_size=None):
+        self.data = data
+        self.bgr = bgr
+        self.decode_ms = decode_ms
+        self.original_size = original_size or (bgr.shape[1], bgr.shape[0])
+        self._digest = None
+    
+    @property
+    def rgb(self):
+        return self.bgr[..., ::-1]
+    
+    @property
+    def digest(self):
+        if self._digest is None:
+            self._digest = hashlib.sha256(self.data).hexdigest()
+        return self._digest
+    
+    def canvas(self):
+        """PIL image to draw on - unpacked straight from the BGR buffer in one copy"""
+        height, width = self.bgr.shape[:2]
+        return Image.frombuffer("RGB", (width, height), self.bgr, "raw", "BGR", 0, 1)
+
+def read_upload(image_file):
+    """All bytes of an uploaded file (or path) without disturbing its position"""
+    if isinstance(image_file, (bytes, bytearray)):
+        return bytes(image_file)
+    if isinstance(image_file, str):
+        with open(image_file, "rb") as f:
+            return f.read()
+    if hasattr(image_file, 'getvalue'):
+        return image_file.getvalue()
+    image_file.seek(0)
+    data = image_file.read()
+    image_file.seek(0)
+    return data
+
+def required_long_edge():
+    """Smallest long edge that still feeds the models (and tiles) at full detail"""
+    if DECODE_MIN_EDGE > 0:
+        return DECODE_MIN_EDGE
+    if TILED_INFERENCE:
+        # Widest image the tile grid covers at native resolution
+        cols = max(1, int(np.sqrt(MAX_TILES)))
+        return int(TILE_SIZE * (1 + (cols - 1) * (1 - TILE_OVERLAP)))
+    return DETECT_IMGSZ
+
+def read_header(data):
+    """
+    Format and size from the image header only (no pixel data is decoded)
+    
+    Raises:
+        ValueError: If the image has more than MAX_IMAGE_PIXELS pixels
+    """
+    with Image.open(io.BytesIO(data)) as header:
+        width, height = header.size
+        image_format = header.format
+    if width * height > MAX_IMAGE_PIXELS:
+        raise ValueError(f"{width}x{height} exceeds the {MAX_IMAGE_PIXELS / 1e6:.0f} MP limit")
+    return image_format, width, height
+
+def reduction_factor(width, height):
+    """Largest of 1, 2, 4, 8 that keeps the long edge at or above the required size"""
+    if not REDUCED_DECODE:
+        return 1
+    factor = 1
+    while factor < 8 and max(width, height) // (factor * 2) >= required_long_edge():
+        factor *= 2
+    return factor
+
+REDUCED_DECODE_FLAGS = {
+    1: cv2.IMREAD_COLOR,
+    2: cv2.IMREAD_REDUCED_COLOR_2,
+    4: cv2.IMREAD_REDUCED_COLOR_4,
+    8: cv2.IMREAD_REDUCED_COLOR_8
+}
+
+def decode_bytes(data, image_format=None, size=None):
+    """
+    Decode image bytes straight into a BGR array
+    
+    OpenCV decodes from a zero-copy view of the bytes. JPEGs larger than the
+    models need are decoded at 1/2, 1/4 or 1/8 scale by the JPEG decoder
+    itself; other formats are decoded and then shrunk to the same bound.
+    EXIF orientation is ignored, like the PIL path always did, so boxes line
+    up with the stored image. Formats OpenCV can't read fall back to PIL.
+    """
+    width, height = size or (0, 0)
+    factor = reduction_factor(width, height) if size else 1
+    flags = REDUCED_DECODE_FLAGS[factor] if image_format == "JPEG" else cv2.IMREAD_COLOR
+    bgr = cv2.imdecode(np.frombuffer(data, np.uint8), flags | cv2.IMREAD_IGNORE_ORIENTATION)
+    if bgr is None:
+        pil_image = Image.open(io.BytesIO(data))
+        if factor > 1:
+            # JPEG draft mode picks the matching DCT scale; a no-op elsewhere
+            pil_image.draft("RGB", (width // factor, height // factor))
+        bgr = cv2.cvtColor(np.asarray(pil_image.convert("RGB")), cv2.COLOR_RGB2BGR)
+    
+    long_edge = max(bgr.shape[:2])
+    if factor > 1 and long_edge >= 2 * required_long_edge():
+        scale = required_long_edge() / long_edge
+        bgr = cv2.resize(bgr, (round(bgr.shape[1] * scale), round(bgr.shape[0] * scale)), interpolation=cv2.INTER_AREA)
+    return bgr
+
+def ingest_image(image_file):
+    """Read the header, then decode an upload once at the size the models need (None if unreadable)"""
+    if isinstance(image_file, IngestedImage):
+        return image_file
+    start = time.perf_counter()
+    try:
+        data = read_upload(image_file)
+        image_format, width, height = read_header(data)
+        bgr = decode_bytes(data, image_format, (width, height))
+    except Exception as e:
+        print(f"Error loading image: {e}")
+        return None
+    if bgr.shape[1] != width:
+        print(f"Decoded {width}x{height} {image_format} at {bgr.shape[1]}x{bgr.shape[0]}")
+    return IngestedImage(data, bgr, (time.perf_counter() - start) * 1000, (width, height))
+
+# =============================================================================
+# DETECTIONS (Compact array-backed model output)
+# =============================================================================
+HEALTHY_LABELS = [
+    "tomato-healthy", "healthy", "tomato_leaf", "tomato_healthy", "tomato healthy", 
+    "healthy leaf", "tomato_healthy_leaf", "healthy_leaf", "tomato healthy", "healthy tomato"
+]
+
+def detection_category(name, source):
+    """'ripeness', 'healthy' or 'disease' - ripeness only applies to fruit"""
+    name_lower = name.lower().strip()
+    if source == "fruit" and name_lower in ["ripe", "unripe"]:
+        return "ripeness"
+    if name_lower in HEALTHY_LABELS:
+        return "healthy"
+    return "disease"
+
+class Detections:
+    """
+    Detections of one or more models as flat arrays, one row per box
+    
+    - xyxy: (N, 4) float32 box corners
+    - conf: (N,) float32 confidences
+    - cls: (N,) int class indices of the model that produced the box
+    - name: (N,) class names
+    - source: (N,) 'fruit' or 'leaf'
+    - category: (N,) 'ripeness', 'healthy' or 'disease'
+    
+    Model output is converted once (see to_detections); thresholding,
+    drawing and analysis then work on whole arrays.
+    """
+    
+    def __init__(self, xyxy, conf, cls, name, source, category):
+        self.xyxy = xyxy
+        self.conf = conf
+        self.cls = cls
+        self.name = name
+        self.source = source
+        self.category = category
+    
+    def __len__(self):
+        return len(self.conf)
+    
+    def __getitem__(self, index):
+        """Subset by boolean mask or index array"""
+        return Detections(self.xyxy[index], self.conf[index], self.cls[index],
+                          self.name[index], self.source[index], self.category[index])
+    
+    def good(self):
+        """Mask of boxes drawn green: healthy plants and ripe fruit"""
+        return (self.category == "healthy") | (np.char.lower(self.name) == "ripe")
+
+def empty_detections():
+    return Detections(np.zeros((0, 4), dtype=np.float32), np.zeros(0, dtype=np.float32),
+                      np.zeros(0, dtype=int), np.zeros(0, dtype=str), np.zeros(0, dtype=str), np.zeros(0, dtype=str))
+
+def to_detections(results, names, source, min_conf=0.25):
+    """
+    Convert YOLO results (first image) into Detections in one pass
+    
+    Names and categories are looked up per class once and then indexed
+    by the class column, so the cost does not grow with Python work per box.
+    
+    Args:
+        results: YOLO results list (or None)
+        names: Class names of the model (dict or list)
+        source: 'fruit' or 'leaf'
+        min_conf: Keep boxes with confidence above this
+    """
+    if not results or getattr(results[0], 'boxes', None) is None or len(results[0].boxes) == 0:
+        return empty_detections()
+    data = results[0].boxes.data.cpu().numpy()
+    data = data[data[:, 4] > min_conf]
+    
+    keys = list(names.keys()) if isinstance(names, dict) else list(range(len(names)))
+    labels = np.array([str(names[k]) for k in keys]) if keys else np.zeros(0, dtype=str)
+    label_table = np.full(max(keys, default=-1) + 1, "", dtype=labels.dtype)
+    label_table[keys] = labels
+    category_table = np.array([detection_category(label, source) for label in label_table] or [""])
+    
+    classes = data[:, 5].astype(int)
+    return Detections(
+        data[:, :4].astype(np.float32),
+        data[:, 4].astype(np.float32),
+        classes,
+        label_table[classes],
+        np.full(len(classes), source),
+        category_table[classes]
+    )
+
+def concat_detections(parts):
+    """Stack several Detections into one"""
+    parts = [part for part in parts if part is not None]
+    if not parts:
+        return empty_detections()
+    return Detections(*(np.concatenate([getattr(part, field) for part in parts])
+                        for field in ["xyxy", "conf", "cls", "name", "source", "category"]))
+
+def draw_detections(img_pil, detections):
+    """Draw boxes and labels (green: healthy/ripe, red: disease/unripe) onto a PIL image"""
+    return draw_labeled_boxes(img_pil, detections.xyxy, detections.name.tolist(), detections.conf.tolist(), detections.good())
+
+def box_iou(boxes_a, boxes_b):
+    """IoU matrix between two (N, 4) and (M, 4) xyxy arrays"""
+    top_left = np.maximum(boxes_a[:, None, :2], boxes_b[None, :, :2])
+    bottom_right = np.minimum(boxes_a[:, None, 2:], boxes_b[None, :, 2:])
+    intersection = np.clip(bottom_right - top_left, 0, None).prod(axis=2)
+    area_a = (boxes_a[:, 2:] - boxes_a[:, :2]).prod(axis=1)
+    area_b = (boxes_b[:, 2:] - boxes_b[:, :2]).prod(axis=1)
+    return intersection / np.maximum(area_a[:, None] + area_b[None, :] - intersection, 1e-9)
+
+DUPLICATE_ACTIONS = {"both": 0, "higher": 1, "fruit": 2, "leaf": 3}
+
+def parse_duplicate_rules(spec):
+    """
+    Parse DUPLICATE_RULES into (fruit_pattern, leaf_pattern, action, iou) tuples
+    
+    Malformed entries are skipped with a warning.
+    """
+    rules = []
+    for entry in spec.split(","):
+        entry = entry.strip()
+        if not entry:
+            continue
+        try:
+            pair, action = entry.split("=")
+            fruit_pattern, leaf_pattern = (part.strip().lower() for part in pair.split(":"))
+            action, _, iou = action.strip().lower().partition("@")
+            if action not in DUPLICATE_ACTIONS:
+                raise ValueError(action)
+            rules.append((fruit_pattern, leaf_pattern, action, float(iou) if iou else DUPLICATE_IOU))
+        except ValueError:
+            print(f"Ignoring duplicate rule '{entry}'")
+    return rules
+
+DUPLICATE_RULE_LIST = parse_duplicate_rules(DUPLICATE_RULES)
+
+def rule_matches(pattern, label, source):
+    """True if a rule pattern ('*', '#category' or a class name) covers a class"""
+    if pattern.startswith("#"):
+        return detection_category(label, source) == pattern[1:]
+    return pattern in ("*", label.lower())
+
+def duplicate_rule_tables(fruit_labels, leaf_labels):
+    """Action code and IoU threshold for every (fruit class, leaf class) pair"""
+    actions = np.zeros((len(fruit_labels), len(leaf_labels)), dtype=int)
+    thresholds = np.ones((len(fruit_labels), len(leaf_labels)), dtype=np.float32)
+    for i, fruit_label in enumerate(fruit_labels):
+        for j, leaf_label in enumerate(leaf_labels):
+            for fruit_pattern, leaf_pattern, action, iou in DUPLICATE_RULE_LIST:
+                if rule_matches(fruit_pattern, fruit_label, "fruit") and rule_matches(leaf_pattern, leaf_label, "leaf"):
+                    actions[i, j] = DUPLICATE_ACTIONS[action]
+                    thresholds[i, j] = iou
+    return actions, thresholds
+
+def suppress_duplicates(fruit, leaf):
+    """
+    Reconcile fruit and leaf detections of the same image
+    
+    Every fruit/leaf box pair is compared at once: an IoU matrix plus
+    per-class-pair action and threshold tables (built over the distinct
+    class names, then expanded by index) find the overlapping pairs and
+    the losing side of each. The pairs are then resolved in one greedy
+    pass, most confident winner first, and a box that was already dropped
+    no longer suppresses anything, so the result does not depend on the
+    order the experts reported their boxes in.
+    
+    Args:
+        fruit: Detections from the fruit expert
+        leaf: Detections from the leaf expert
+    
+    Returns:
+        tuple: (fruit_kept, leaf_kept, suppressed_count)
+    """
+    if len(fruit) == 0 or len(leaf) == 0:
+        return fruit, leaf, 0
+    fruit_labels, fruit_index = np.unique(fruit.name, return_inverse=True)
+    leaf_labels, leaf_index = np.unique(leaf.name, return_inverse=True)
+    actions, thresholds = duplicate_rule_tables(fruit_labels.tolist(), leaf_labels.tolist())
+    pair_actions = actions[fruit_index[:, None], leaf_index[None, :]]
+    overlap = box_iou(fruit.xyxy, leaf.xyxy) >= thresholds[fruit_index[:, None], leaf_index[None, :]]
+    overlap &= pair_actions != DUPLICATE_ACTIONS["both"]
+    
+    fruit_wins = fruit.conf[:, None] >= leaf.conf[None, :]
+    higher = pair_actions == DUPLICATE_ACTIONS["higher"]
+    drop_fruit = (pair_actions == DUPLICATE_ACTIONS["leaf"]) | (higher & ~fruit_wins)
+    
+    # Only the overlapping pairs, ordered by winner then loser confidence
+    fruit_ids, leaf_ids = np.nonzero(overlap)
+    pair_drop_fruit = drop_fruit[fruit_ids, leaf_ids]
+    fruit_conf = fruit.conf[fruit_ids]
+    leaf_conf = leaf.conf[leaf_ids]
+    winner_conf = np.where(pair_drop_fruit, leaf_conf, fruit_conf)
+    loser_conf = np.where(pair_drop_fruit, fruit_conf, leaf_conf)
+    order = np.lexsort((leaf_ids, fruit_ids, -loser_conf, -winner_conf))
+    
+    keep_fruit = np.ones(len(fruit), dtype=bool)
+    keep_leaf = np.ones(len(leaf), dtype=bool)
+    for k in order.tolist():
+        i, j = fruit_ids[k], leaf_ids[k]
+        if keep_fruit[i] and keep_leaf[j]:
+            if pair_drop_fruit[k]:
+                keep_fruit[i] = False
+            else:
+                keep_leaf[j] = False
+    suppressed = int((~keep_fruit).sum() + (~keep_leaf).sum())
+    if suppressed:
+        print(f"Suppressed {suppressed} cross-model duplicate box(es)")
+    return fruit[keep_fruit], leaf[keep_leaf], suppressed
+
+def add_to_analysis(analysis, detections, detections_key, label):
+    """
+    Fill an analysis dict from Detections
+    
+    Args:
+        analysis: Analysis dict being built (see analyze_manual_results)
+        detections: Detections of one source
+        detections_key: List in the analysis that gets one entry per box
+        label: Name used in the log ("Fruit", "Leaf", ...)
+    """
+    if len(detections) == 0:
+        return
+    print(f"Analyzing {label} detections...")
+    names = detections.name.tolist()
+    confs = detections.conf.tolist()
+    for name, conf, category in zip(names, confs, detections.category.tolist()):
+        print(f"  {label}: {name} ({conf:.2%})")
+        analysis[detections_key].append({
+            "type": category,
+            "name": name,
+            "confidence": conf
+        })
+    analysis['max_conf'] = max(analysis['max_conf'], float(detections.conf.max()))
+    
+    ripeness = detections[detections.category == "ripeness"]
+    analysis['ripeness_list'].extend(
+        {"name": name.title(), "confidence": conf}
+        for name, conf in zip(ripeness.name.tolist(), ripeness.conf.tolist())
+    )
+    
+    diseases = detections[detections.category == "disease"]
+    if len(diseases):
+        analysis['has_disease'] = True
+        analysis['diseases'].extend(
+            {
+                "name": name,
+                "normalized_name": normalize_disease_name(name),
+                "confidence": conf,
+                "source": source
+            }
+            for name, conf, source in zip(diseases.name.tolist(), diseases.conf.tolist(), diseases.source.tolist())
+        )
+
+# =============================================================================
+# DETECTION FUNCTIONS
+# =============================================================================
+def draw_boxes(image, results, detection_mode, model):
+    img_pil = Image.fromarray(image) if isinstance(image, np.ndarray) else image.copy()
+    source = "fruit" if detection_mode == "Tomato Fruit" else "leaf"
+    for result in results:
+        draw_detections(img_pil, to_detections([result], model.names, source, min_conf=0.4))
+    return img_pil
+
+def process(image_file, detection_mode):
+    """Process image with the appropriate model based on detection mode"""
+    # Select the appropriate model
+    if detection_mode == "Tomato Fruit":
+        model = models.get('fruit')
+        if model is None:
+            st.error("❌ Fruit detection model not loaded.")
+            return None, None
+    else:  # Tomato Leaf
+        model = models.get('leaf')
+        if model is None:
+            st.error("❌ Leaf disease detection model not loaded.")
+            return None, None
+    
+    image_bytes = image_file.read()
+    nparr = np.frombuffer(image_bytes, np.uint8)
+    image_cv = cv2.imdecode(nparr, cv2.COLOR_BGR2RGB)
+    
+    mode_text = "tomato fruit ripeness & diseases" if detection_mode == "Tomato Fruit" else "tomato leaf diseases"
+    with st.spinner(f"🔍 Analyzing {mode_text}..."):
+        results = model.predict(source=image_cv, conf=0.5)
+    
+    output = draw_boxes(image_cv, results, detection_mode, model)
+    return output, results
+
+def draw_classification_result(image, result, model):
+    """
+    Visualize CLASSIFICATION results (not detection boxes)
+    
+    Args:
+        image: Input image (numpy array from OpenCV)
+        result: YOLO classification result with .probs attribute
+        model: The classification model (for class names)
+    
+    Returns:
+        PIL Image with classification overlay showing:
+        - Colored border (green for healthy, red for diseased)
+        - Top prediction with confidence
+        - Semi-transparent header bar
+    """
+    # Convert OpenCV image (BGR) to PIL (RGB)
+    if isinstance(image, np.ndarray):
+        img_pil = Image.fromarray(cv2.cvtColor(image, cv2.COLOR_BGR2RGB))
+    else:
+        img_pil = image.copy()
+    
+    # Verify this is a classification result
+    if not hasattr(result, 'probs') or result.probs is None:
+        # Fallback: just return the image with an error message
+        draw = ImageDraw.Draw(img_pil)
+        draw.text((10, 10), "Classification Error", fill='red')
+        return img_pil
+    
+    # Get classification results
+    probs = result.probs
+    top_idx = int(probs.top1)
+    top_conf = float(probs.top1conf)
+    top_name = model.names[top_idx]
+    
+    # Get image dimensions
+    width, height = img_pil.size
+    
+    # Determine color based on health status
+    healthy_labels = [
+        "tomato-healthy", "healthy","tomato_leaf", "tomato_healthy", "tomato healthy",
         "healthy leaf", "tomato_healthy_leaf", "healthy_leaf"
     ]
     is_healthy = top_name.lower().strip() in healthy_labels
@@ -1039,104 +3363,189 @@ def draw_classification_result(image, result, model):
     
     return img_pil
 
-def run_manual_mode_pipeline(image_file, models, mode):
+def run_expert(models, model_key, image_hash=None, imgsz=None):
+    """
+    Build a task that runs one expert model on an image
+    
+    Args:
+        models: Dictionary containing all models
+        model_key: 'fruit_expert' or 'leaf_expert'
+        image_hash: Hash of the uploaded bytes, enables the result cache
+        imgsz: Single pass at this size instead of the normal path
+    
+    Returns:
+        function: Takes the BGR image and returns (results, count, elapsed_ms)
+    """
+    label = "Fruit" if model_key == "fruit_expert" else "Leaf"
+    
+    def task(img_cv):
+        results = None
+        count = 0
+        start = time.perf_counter()
+        try:
+            print(f"Running {label} Detection Model...")
+            predict_args = {'conf': 0.25, 'imgsz': imgsz} if imgsz else {'conf': 0.25}
+            # Latency estimates used by the request deadline (real runs only)
+            results = predict_expert(models, model_key, img_cv, image_hash=image_hash, observe=True, **predict_args)
+            count = len(results[0].boxes) if hasattr(results[0], 'boxes') else 0
+            print(f"{label} Model: Detected {count} object(s)")
+        except Exception as e:
+            print(f"{label} model error: {e}")
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        return results, count, elapsed_ms
+    
+    return task
+
+def run_experts(models, model_keys, img_cv, parallel=None, image_hash=None, deadline=None, imgsz=None):
+    """
+    Run several expert models on the same decoded image
+    
+    Args:
+        models: Dictionary containing all models
+        model_keys: List of expert keys to run
+        img_cv: Decoded BGR image shared by all experts
+        parallel: Run experts concurrently (defaults to PARALLEL_EXPERTS)
+        image_hash: Hash of the uploaded bytes, enables the result cache
+        deadline: Optional Deadline; experts still running when it expires
+            are abandoned and reported as (None, 0)
+        imgsz: Single pass at this size instead of the normal path
+    
+    Returns:
+        tuple: (outputs, timings)
+        - outputs: Dict of model_key -> (results, count)
+        - timings: Dict with per-expert and wall-clock time in ms
+    """
+    if parallel is None:
+        parallel = PARALLEL_EXPERTS
+    parallel = parallel and len(model_keys) > 1
+    
+    start = time.perf_counter()
+    if deadline is not None and deadline.enabled:
+        # Run on the pool even when sequential so the wait can time out
+        executor = get_expert_executor()
+        futures = {}
+        if parallel:
+            futures = {key: executor.submit(run_expert(models, key, image_hash, imgsz), img_cv) for key in model_keys}
+        raw = {}
+        for key in model_keys:
+            future = futures.get(key)
+            if future is None:
+                if deadline.remaining_ms() <= 0:
+                    # Out of time: don't queue more work on the shared pool
+                    deadline.degrade("expert_timeout")
+                    raw[key] = (None, 0, 0.0)
+                    continue
+                future = executor.submit(run_expert(models, key, image_hash, imgsz), img_cv)
+            try:
+                raw[key] = future.result(timeout=deadline.timeout())
+            except FutureTimeout:
+                # Queued work is dropped; a task already running finishes in
+                # the background and its result is discarded
+                deadline.degrade("expert_timeout")
+                future.cancel()
+                raw[key] = (None, 0, (time.perf_counter() - start) * 1000)
+    elif parallel:
+        # Each expert has its own model object, so they can run side by side;
+        # torch releases the GIL inside its kernels
+        executor = get_expert_executor()
+        futures = {key: executor.submit(run_expert(models, key, image_hash, imgsz), img_cv) for key in model_keys}
+        raw = {key: future.result() for key, future in futures.items()}
+    else:
+        raw = {key: run_expert(models, key, image_hash, imgsz)(img_cv) for key in model_keys}
+    wall_ms = (time.perf_counter() - start) * 1000
+    
+    outputs = {key: (results, count) for key, (results, count, _) in raw.items()}
+    timings = {f"{key}_ms": elapsed_ms for key, (_, _, elapsed_ms) in raw.items()}
+    timings['inference_wall_ms'] = wall_ms
+    timings['execution'] = "parallel" if parallel else "sequential"
+    return outputs, timings
+
+def run_manual_mode_pipeline(image_file, models, mode, deadline=None):
     """
     Manual Mode Pipeline - Run only the selected model
     
     Args:
-        image_file: Uploaded image file
+        image_file: IngestedImage (or an uploaded file, ingested here)
         models: Dictionary containing all models
         mode: Either "Tomato Fruit Only" or "Tomato Leaf Only"
+        deadline: Latency budget (defaults to REQUEST_BUDGET_MS)
     
     Returns:
-        tuple: (output_image, results, detection_summary)
+        tuple: (output_image, detections, detection_summary)
     """
+    if deadline is None:
+        deadline = Deadline(REQUEST_BUDGET_MS)
+    
     # =========================================================================
-    # IMAGE PREPROCESSING
+    # IMAGE INGESTION (Decoded once, models read the same buffer)
     # =========================================================================
-    try:
-        img_pil = Image.open(image_file).convert("RGB")
-        img_cv = cv2.cvtColor(np.array(img_pil), cv2.COLOR_RGB2BGR)
-    except Exception as e:
-        print(f"Error loading image: {e}")
+    image = ingest_image(image_file)
+    if image is None:
         return None, None, {"status": "error", "message": "Failed to load image"}
+    img_cv = image.bgr
     
     # =========================================================================
     # RUN SELECTED MODEL ONLY
     # =========================================================================
-    results = None
-    detection_count = 0
-    model_name = ""
-    
-    if mode == "Tomato Fruit Only":
-        model_name = "fruit_expert"
-        try:
-            print("Running Fruit Detection Model (Manual Mode)...")
-            results = models['fruit_expert'].predict(img_cv, conf=0.25, verbose=False)
-            detection_count = len(results[0].boxes) if hasattr(results[0], 'boxes') else 0
-            print(f"Fruit Model: Detected {detection_count} object(s)")
-        except Exception as e:
-            print(f"Fruit model error: {e}")
-            
-    elif mode == "Tomato Leaf Only":
-        model_name = "leaf_expert"
-        try:
-            print("Running Leaf Detection Model (Manual Mode)...")
-            results = models['leaf_expert'].predict(img_cv, conf=0.25, verbose=False)
-            detection_count = len(results[0].boxes) if hasattr(results[0], 'boxes') else 0
-            print(f"Leaf Model: Detected {detection_count} object(s)")
-        except Exception as e:
-            print(f"Leaf model error: {e}")
+    model_name = "fruit_expert" if mode == "Tomato Fruit Only" else "leaf_expert"
+    expert_keys, imgsz = plan_experts(deadline, [model_name])
+    print(f"Running {mode} (Manual Mode)...")
+    outputs, _ = run_experts(models, expert_keys, img_cv, image_hash=image.digest,
+                             deadline=deadline, imgsz=imgsz)
+    results, detection_count = outputs[model_name]
     
     # =========================================================================
     # CHECK IF ANYTHING WAS DETECTED
     # =========================================================================
+    if results is None and "expert_timeout" in deadline.degraded:
+        print(f"MANUAL MODE: {mode} did not finish within the latency budget")
+        return image.rgb, None, {
+            'status': 'deadline_exceeded',
+            'mode': mode,
+            'count': 0,
+            'degraded': deadline.finish()
+        }
+    
     if detection_count == 0:
         print(f"MANUAL MODE: Nothing detected in {mode}")
-        return img_cv, None, {
+        return image.rgb, None, {
             'status': 'nothing_detected',
             'mode': mode,
-            'count': 0
+            'count': 0,
+            'degraded': deadline.finish()
         }
     
     # =========================================================================
-    # DRAW BOUNDING BOXES
+    # DRAW BOUNDING BOXES (Skipped when the budget is spent)
     # =========================================================================
     print(f"MANUAL MODE: Detected {detection_count} object(s) in {mode}")
     
-    img_pil = Image.fromarray(cv2.cvtColor(img_cv, cv2.COLOR_BGR2RGB))
-    draw = ImageDraw.Draw(img_pil)
-    
-    for box in results[0].boxes:
-        conf = float(box.conf[0])
-        if conf > 0.25:
-            x1, y1, x2, y2 = box.xyxy[0].cpu().numpy().astype(int)
-            cls = int(box.cls[0])
-            name = models[model_name].names[cls]
-            
-            # Color: Green for healthy/ripe, Red for diseases/unripe
-            if name.lower() in ["healthy", "ripe", "tomato-healthy", "tomato_healthy"]:
-                color = "#4CAF50"  # Green
-            else:
-                color = "#F44336"  # Red
-            
-            draw.rectangle([x1, y1, x2, y2], outline=color, width=4)
-            draw.text((x1, y1-20), f"{name} {conf:.1%}", fill=color)
+    source = "fruit" if model_name == "fruit_expert" else "leaf"
+    detections = to_detections(results, models[model_name].names, source)
+    if deadline.fits(get_pipeline_stats().estimate('draw_ms')):
+        draw_start = time.perf_counter()
+        img_pil = draw_detections(image.canvas(), detections)
+        get_pipeline_stats().observe('draw_ms', (time.perf_counter() - draw_start) * 1000)
+    else:
+        deadline.degrade("no_render")
+        get_pipeline_stats().decay('draw_ms')
+        img_pil = image.rgb
     
-    return img_pil, results, {
+    return img_pil, detections, {
         'status': 'detected',
         'mode': mode,
-        'count': detection_count
+        'count': detection_count,
+        'degraded': deadline.finish()
     }
 
-def analyze_manual_results(results, mode, models):
+def analyze_manual_results(detections, mode, models):
     """
     Analyze results from manual mode (single model)
     
     Args:
-        results: YOLO results from the selected model
+        detections: Detections from the selected model
         mode: "Tomato Fruit Only" or "Tomato Leaf Only"
-        models: Model dictionary to get class names
+        models: Model dictionary (kept for callers; names are in the detections)
     
     Returns:
         dict: Analysis with all detections
@@ -1151,72 +3560,11 @@ def analyze_manual_results(results, mode, models):
         'detections': []
     }
     
-    # Define healthy labels
-    HEALTHY_LABELS = [
-        "tomato-healthy", "healthy", "tomato_leaf", "tomato_healthy", "tomato healthy", 
-        "healthy leaf", "tomato_healthy_leaf", "healthy_leaf", "tomato healthy", "healthy tomato"
-    ]
-    
-    # Select the appropriate model
-    if mode == "Tomato Fruit Only":
-        model = models['fruit_expert']
-        source_type = "fruit"
-    else:  # Tomato Leaf Only
-        model = models['leaf_expert']
-        source_type = "leaf"
-    
     # =========================================================================
     # ANALYZE DETECTIONS
     # =========================================================================
-    if results and len(results[0].boxes) > 0:
-        print(f"Analyzing {mode} detections...")
-        for box in results[0].boxes:
-            conf = float(box.conf[0])
-            if conf > 0.25:
-                cls = int(box.cls[0])
-                raw_name = model.names[cls]
-                raw_name_lower = raw_name.lower().strip()
-                
-                print(f"  {mode}: {raw_name} ({conf:.2%})")
-                
-                # Track max confidence
-                if conf > analysis['max_conf']:
-                    analysis['max_conf'] = conf
-                
-                # Categorize detection
-                if mode == "Tomato Fruit Only" and raw_name_lower in ["ripe", "unripe"]:
-                    # Ripeness (only for fruit)
-                    analysis['ripeness_list'].append({
-                        "name": raw_name.title(),
-                        "confidence": conf
-                    })
-                    analysis['detections'].append({
-                        "type": "ripeness",
-                        "name": raw_name,
-                        "confidence": conf
-                    })
-                elif raw_name_lower in HEALTHY_LABELS:
-                    # Healthy
-                    analysis['detections'].append({
-                        "type": "healthy",
-                        "name": raw_name,
-                        "confidence": conf
-                    })
-                else:
-                    # Disease
-                    analysis['has_disease'] = True
-                    disease_entry = {
-                        "name": raw_name,
-                        "normalized_name": normalize_disease_name(raw_name),
-                        "confidence": conf,
-                        "source": source_type
-                    }
-                    analysis['diseases'].append(disease_entry)
-                    analysis['detections'].append({
-                        "type": "disease",
-                        "name": raw_name,
-                        "confidence": conf
-                    })
+    if detections is not None:
+        add_to_analysis(analysis, detections, 'detections', mode)
     
     # =========================================================================
     # DETERMINE FINAL STATUS
@@ -1238,7 +3586,82 @@ def analyze_manual_results(results, mode, models):
     
     return analysis
 
-def run_ai_pipeline(image_file, models):
+# Expert(s) per gatekeeper class. Classifier.pt only has the classes 'tomato'
+# and 'tomato_leaf', so it cannot reject an image: 'invalid' is only reachable
+# with a retrained classifier whose reject class is added here. 'both' happens
+# when the top-1 confidence is below GATEKEEPER_MARGIN (or for unlisted classes).
+GATEKEEPER_ROUTES = {
+    'tomato': 'fruit',
+    'tomato_leaf': 'leaf',
+}
+
+def gatekeeper_routes(names):
+    """
+    Route for every class the loaded gatekeeper can predict
+    
+    Args:
+        names: Class index -> class name of the gatekeeper model
+    
+    Returns:
+        dict: class index -> 'fruit', 'leaf', 'both' or 'invalid'
+    """
+    return {index: GATEKEEPER_ROUTES.get(name, "both") for index, name in names.items()}
+
+def classify_with_gatekeeper(models, img_cv):
+    """
+    Classify a small thumbnail of the image with the gatekeeper (Classifier.pt)
+    
+    Args:
+        models: Dictionary containing all models
+        img_cv: Decoded BGR image
+    
+    Returns:
+        dict: route, label, confidence, elapsed_ms
+        - route is 'both' when the gatekeeper fails or is unsure; it is
+          never 'invalid' with Classifier.pt (see GATEKEEPER_ROUTES)
+    """
+    start = time.perf_counter()
+    routing = {'route': 'both', 'label': None, 'confidence': 0.0}
+    try:
+        # Classify a thumbnail, the gatekeeper does not need full resolution
+        height, width = img_cv.shape[:2]
+        scale = GATEKEEPER_IMGSZ / max(height, width)
+        if scale < 1:
+            thumb = cv2.resize(img_cv, (max(1, int(width * scale)), max(1, int(height * scale))), interpolation=cv2.INTER_AREA)
+        else:
+            thumb = img_cv
+        
+        gatekeeper = models['gatekeeper']
+        result = gatekeeper.predict(thumb, imgsz=GATEKEEPER_IMGSZ, verbose=False)[0]
+        top1 = int(result.probs.top1)
+        label = gatekeeper.names[top1]
+        confidence = float(result.probs.top1conf)
+        routing['label'] = label
+        routing['confidence'] = confidence
+        
+        # Only trust the gatekeeper when it is confident enough
+        if confidence >= GATEKEEPER_MARGIN:
+            routing['route'] = gatekeeper_routes(gatekeeper.names)[top1]
+        print(f"Gatekeeper: {label} ({confidence:.2%}) -> {routing['route']}")
+    except Exception as e:
+        print(f"Gatekeeper error: {e}")
+    routing['elapsed_ms'] = (time.perf_counter() - start) * 1000
+    return routing
+
+def format_timings(timings):
+    """One-line timing breakdown for logs and the results page"""
+    parts = [f"execution: {timings.get('execution', 'sequential')}"]
+    for key, label in [('decode_ms', 'decode'), ('gatekeeper_ms', 'gatekeeper'), ('fruit_expert_ms', 'fruit'),
+                       ('leaf_expert_ms', 'leaf'), ('inference_wall_ms', 'inference wall'),
+                       ('draw_ms', 'draw'), ('total_ms', 'total')]:
+        if key in timings:
+            parts.append(f"{label}: {timings[key]:.0f} ms")
+    return " | ".join(parts)
+
+def print_timings(timings):
+    print(f"TIMINGS: {format_timings(timings)}")
+
+def run_ai_pipeline(image_file, models, deadline=None):
     """
     NEW Dual-Detection AI Pipeline
     
@@ -1247,119 +3670,147 @@ def run_ai_pipeline(image_file, models):
     Only show "NOTHING DETECTED" if BOTH models find nothing
     
     Args:
-        image_file: Uploaded image file
+        image_file: IngestedImage (or an uploaded file, ingested here)
         models: Dictionary containing all models
+        deadline: Latency budget (defaults to REQUEST_BUDGET_MS)
     
     Returns:
         tuple: (output_image, combined_results, detection_summary)
         - output_image: Image with bounding boxes from both models
-        - combined_results: Dict with 'fruit' and 'leaf' results
+        - combined_results: Dict with 'fruit' and 'leaf' Detections
         - detection_summary: Dict with what was found
     """
+    pipeline_start = time.perf_counter()
+    if deadline is None:
+        deadline = Deadline(REQUEST_BUDGET_MS)
+    
     # =========================================================================
-    # IMAGE PREPROCESSING
+    # IMAGE INGESTION (Decoded once, models and renderer share the buffer)
     # =========================================================================
-    try:
-        img_pil = Image.open(image_file).convert("RGB")
-        img_cv = cv2.cvtColor(np.array(img_pil), cv2.COLOR_RGB2BGR)
-    except Exception as e:
-        print(f"Error loading image: {e}")
+    image = ingest_image(image_file)
+    if image is None:
         return None, None, {"status": "error", "message": "Failed to load image"}
+    img_cv = image.bgr
+    decode_ms = image.decode_ms
     
     # =========================================================================
-    # RUN BOTH MODELS
+    # GATEKEEPER ROUTING (Optional - pick which expert(s) to run)
     # =========================================================================
-    fruit_results = None
-    leaf_results = None
-    fruit_count = 0
-    leaf_count = 0
-    
-    # Run Fruit Model
-    try:
-        print("Running Fruit Detection Model...")
-        fruit_results = models['fruit_expert'].predict(img_cv, conf=0.25, verbose=False)
-        fruit_count = len(fruit_results[0].boxes) if hasattr(fruit_results[0], 'boxes') else 0
-        print(f"Fruit Model: Detected {fruit_count} object(s)")
-    except Exception as e:
-        print(f"Fruit model error: {e}")
+    routing = None
+    expert_keys = ['fruit_expert', 'leaf_expert']
+    if AUTO_DETECT_ROUTING == "gatekeeper" and 'gatekeeper' in models:
+        routing = classify_with_gatekeeper(models, img_cv)
+        if routing['route'] == "invalid":
+            print("FINAL RESULT: Gatekeeper rejected the image")
+            timings = {
+                'decode_ms': decode_ms,
+                'gatekeeper_ms': routing['elapsed_ms'],
+                'total_ms': (time.perf_counter() - pipeline_start) * 1000
+            }
+            print_timings(timings)
+            return image.rgb, {
+                'fruit': None,
+                'leaf': None
+            }, {
+                'status': 'invalid_image',
+                'fruit_count': 0,
+                'leaf_count': 0,
+                'routing': routing,
+                'timings': timings,
+                'degraded': deadline.finish()
+            }
+        if routing['route'] == "fruit":
+            expert_keys = ['fruit_expert']
+        elif routing['route'] == "leaf":
+            expert_keys = ['leaf_expert']
     
-    # Run Leaf Model
-    try:
-        print("Running Leaf Detection Model...")
-        leaf_results = models['leaf_expert'].predict(img_cv, conf=0.25, verbose=False)
-        leaf_count = len(leaf_results[0].boxes) if hasattr(leaf_results[0], 'boxes') else 0
-        print(f"Leaf Model: Detected {leaf_count} object(s)")
-    except Exception as e:
-        print(f"Leaf model error: {e}")
+    # =========================================================================
+    # RUN EXPERT MODELS (Concurrently unless PARALLEL_EXPERTS is off)
+    # =========================================================================
+    expert_keys, imgsz = plan_experts(deadline, expert_keys)
+    outputs, timings = run_experts(models, expert_keys, img_cv, image_hash=image.digest,
+                                   deadline=deadline, imgsz=imgsz)
+    fruit_results, fruit_count = outputs.get('fruit_expert', (None, 0))
+    leaf_results, leaf_count = outputs.get('leaf_expert', (None, 0))
+    fruit_detections = to_detections(fruit_results, models['fruit_expert'].names, "fruit") if fruit_count else empty_detections()
+    leaf_detections = to_detections(leaf_results, models['leaf_expert'].names, "leaf") if leaf_count else empty_detections()
+    suppressed = 0
+    if DUPLICATE_SUPPRESSION:
+        fruit_detections, leaf_detections, suppressed = suppress_duplicates(fruit_detections, leaf_detections)
+        fruit_count, leaf_count = len(fruit_detections), len(leaf_detections)
+        get_pipeline_stats().increment('duplicates_suppressed', suppressed)
+    timings['decode_ms'] = decode_ms
+    if routing:
+        timings['gatekeeper_ms'] = routing['elapsed_ms']
     
     # =========================================================================
     # DETERMINE WHAT WAS DETECTED
     # =========================================================================
     total_detections = fruit_count + leaf_count
     
+    # CASE 0: No expert finished within the latency budget
+    if all(results is None for results, _ in outputs.values()) and "expert_timeout" in deadline.degraded:
+        print("FINAL RESULT: Experts did not finish within the latency budget")
+        timings['total_ms'] = (time.perf_counter() - pipeline_start) * 1000
+        print_timings(timings)
+        return image.rgb, {
+            'fruit': None,
+            'leaf': None
+        }, {
+            'status': 'deadline_exceeded',
+            'fruit_count': 0,
+            'leaf_count': 0,
+            'routing': routing,
+            'timings': timings,
+            'degraded': deadline.finish()
+        }
+    
     # CASE 1: Nothing detected by either model
     if total_detections == 0:
         print("FINAL RESULT: Nothing detected by either model")
-        return img_cv, {
-            'fruit': fruit_results,
-            'leaf': leaf_results
+        timings['draw_ms'] = 0.0
+        timings['total_ms'] = (time.perf_counter() - pipeline_start) * 1000
+        print_timings(timings)
+        return image.rgb, {
+            'fruit': fruit_detections,
+            'leaf': leaf_detections
         }, {
             'status': 'nothing_detected',
             'fruit_count': 0,
-            'leaf_count': 0
+            'leaf_count': 0,
+            'routing': routing,
+            'timings': timings,
+            'degraded': deadline.finish()
         }
     
     # CASE 2: Something was detected - draw boxes from both models
     print(f"FINAL RESULT: Detected {fruit_count} fruit(s) and {leaf_count} leaf/leaves")
     
-    # Create a copy of the image to draw on
-    img_with_boxes = img_cv.copy()
-    img_pil = Image.fromarray(cv2.cvtColor(img_with_boxes, cv2.COLOR_BGR2RGB))
-    draw = ImageDraw.Draw(img_pil)
+    # Draw fruit and leaf detections in one pass (skipped when the budget is spent)
+    draw_start = time.perf_counter()
+    if deadline.fits(get_pipeline_stats().estimate('draw_ms')):
+        img_pil = draw_detections(image.canvas(), concat_detections([fruit_detections, leaf_detections]))
+        get_pipeline_stats().observe('draw_ms', (time.perf_counter() - draw_start) * 1000)
+    else:
+        deadline.degrade("no_render")
+        get_pipeline_stats().decay('draw_ms')
+        img_pil = image.rgb
     
-    # Draw fruit detections (if any)
-    if fruit_count > 0:
-        for box in fruit_results[0].boxes:
-            conf = float(box.conf[0])
-            if conf > 0.25:
-                x1, y1, x2, y2 = box.xyxy[0].cpu().numpy().astype(int)
-                cls = int(box.cls[0])
-                name = models['fruit_expert'].names[cls]
-                
-                # Color: Green for healthy/ripe, Red for diseases/unripe
-                if name.lower() in ["healthy", "ripe", "tomato-healthy"]:
-                    color = "#4CAF50"  # Green
-                else:
-                    color = "#F44336"  # Red
-                
-                draw.rectangle([x1, y1, x2, y2], outline=color, width=4)
-                draw.text((x1, y1-20), f"{name} {conf:.1%}", fill=color)
-    
-    # Draw leaf detections (if any)
-    if leaf_count > 0:
-        for box in leaf_results[0].boxes:
-            conf = float(box.conf[0])
-            if conf > 0.25:
-                x1, y1, x2, y2 = box.xyxy[0].cpu().numpy().astype(int)
-                cls = int(box.cls[0])
-                name = models['leaf_expert'].names[cls]
-                
-                # Color: Green for healthy, Red for diseases
-                if "healthy" in name.lower():
-                    color = "#4CAF50"  # Green
-                else:
-                    color = "#F44336"  # Red
-                
-                draw.rectangle([x1, y1, x2, y2], outline=color, width=4)
-                draw.text((x1, y1-20), f"{name} {conf:.1%}", fill=color)
+    timings['draw_ms'] = (time.perf_counter() - draw_start) * 1000
+    timings['total_ms'] = (time.perf_counter() - pipeline_start) * 1000
+    print_timings(timings)
     
     return img_pil, {
-        'fruit': fruit_results,
-        'leaf': leaf_results
+        'fruit': fruit_detections,
+        'leaf': leaf_detections
     }, {
         'status': 'detected',
         'fruit_count': fruit_count,
-        'leaf_count': leaf_count
+        'leaf_count': leaf_count,
+        'suppressed': suppressed,
+        'routing': routing,
+        'timings': timings,
+        'degraded': deadline.finish()
     }
     
 def analyze_combined_results(combined_results, summary, models):
@@ -1367,9 +3818,9 @@ def analyze_combined_results(combined_results, summary, models):
     Analyze results from BOTH fruit and leaf models
     
     Args:
-        combined_results: Dict with 'fruit' and 'leaf' YOLO results
+        combined_results: Dict with 'fruit' and 'leaf' Detections
         summary: Dict with detection counts
-        models: Model dictionary to get class names
+        models: Model dictionary (kept for callers; names are in the detections)
     
     Returns:
         dict: Combined analysis with all detections
@@ -1385,106 +3836,13 @@ def analyze_combined_results(combined_results, summary, models):
         'leaf_detections': []
     }
     
-    # Define healthy labels
-    HEALTHY_LABELS = [
-        "tomato-healthy", "healthy", "tomato_leaf", "tomato_healthy", "tomato healthy", 
-        "healthy leaf", "tomato_healthy_leaf", "healthy_leaf", "tomato healthy", "healthy tomato"
-    ]
-    
     # =========================================================================
-    # ANALYZE FRUIT RESULTS
+    # ANALYZE FRUIT AND LEAF RESULTS
     # =========================================================================
-    if combined_results['fruit'] and len(combined_results['fruit'][0].boxes) > 0:
-        print("Analyzing fruit detections...")
-        for box in combined_results['fruit'][0].boxes:
-            conf = float(box.conf[0])
-            if conf > 0.25:
-                cls = int(box.cls[0])
-                raw_name = models['fruit_expert'].names[cls]
-                raw_name_lower = raw_name.lower().strip()
-                
-                print(f"  Fruit: {raw_name} ({conf:.2%})")
-                
-                # Track max confidence
-                if conf > analysis['max_conf']:
-                    analysis['max_conf'] = conf
-                
-                # Categorize detection
-                if raw_name_lower in ["ripe", "unripe"]:
-                    # Ripeness
-                    analysis['ripeness_list'].append({
-                        "name": raw_name.title(),
-                        "confidence": conf
-                    })
-                    analysis['fruit_detections'].append({
-                        "type": "ripeness",
-                        "name": raw_name,
-                        "confidence": conf
-                    })
-                elif raw_name_lower in HEALTHY_LABELS:
-                    # Healthy
-                    analysis['fruit_detections'].append({
-                        "type": "healthy",
-                        "name": raw_name,
-                        "confidence": conf
-                    })
-                else:
-                    # Disease
-                    analysis['has_disease'] = True
-                    disease_entry = {
-                        "name": raw_name,
-                        "normalized_name": normalize_disease_name(raw_name),
-                        "confidence": conf,
-                        "source": "fruit"
-                    }
-                    analysis['diseases'].append(disease_entry)
-                    analysis['fruit_detections'].append({
-                        "type": "disease",
-                        "name": raw_name,
-                        "confidence": conf
-                    })
-    
-    # =========================================================================
-    # ANALYZE LEAF RESULTS
-    # =========================================================================
-    if combined_results['leaf'] and len(combined_results['leaf'][0].boxes) > 0:
-        print("Analyzing leaf detections...")
-        for box in combined_results['leaf'][0].boxes:
-            conf = float(box.conf[0])
-            if conf > 0.25:
-                cls = int(box.cls[0])
-                raw_name = models['leaf_expert'].names[cls]
-                raw_name_lower = raw_name.lower().strip()
-                
-                print(f"  Leaf: {raw_name} ({conf:.2%})")
-                
-                # Track max confidence
-                if conf > analysis['max_conf']:
-                    analysis['max_conf'] = conf
-                
-                # Categorize detection
-                if raw_name_lower in HEALTHY_LABELS:
-                    # Healthy
-                    analysis['leaf_detections'].append({
-                        "type": "healthy",
-                        "name": raw_name,
-                        "confidence": conf
-                    })
-                else:
-                    # Disease
-                    analysis['has_disease'] = True
-                    disease_entry = {
-                        "name": raw_name,
-                        "normalized_name": normalize_disease_name(raw_name),
-                        "confidence": conf,
-                        "source": "leaf"
-                    }
-                    analysis['diseases'].append(disease_entry)
-                    analysis['leaf_detections'].append({
-                        "type": "disease",
-                        "name": raw_name,
-                        "confidence": conf
-                    })
+    if combined_results['fruit'] is not None:
+        add_to_analysis(analysis, combined_results['fruit'], 'fruit_detections', "Fruit")
+    if combined_results['leaf'] is not None:
+        add_to_analysis(analysis, combined_results['leaf'], 'leaf_detections', "Leaf")
     
     # =========================================================================
     # DETERMINE FINAL STATUS
@@ -1506,6 +3864,422 @@ def analyze_combined_results(combined_results, summary, models):
     
     return analysis
 
+def predict_batch(models, model_key, images, batch_size=None, image_hashes=None):
+    """
+    Run one expert on many images with batched predict calls
+    
+    Args:
+        models: Dictionary containing all models
+        model_key: 'fruit_expert' or 'leaf_expert'
+        images: List of BGR images
+        batch_size: Images per forward pass (defaults to BATCH_SIZE)
+        image_hashes: Hashes of the uploaded bytes, enables the result cache
+    
+    Returns:
+        list: One (results, count) tuple per image, results shaped like a
+        single-image predict call so the analysis functions can use them
+    """
+    batch_size = batch_size or BATCH_SIZE
+    stats = get_pipeline_stats()
+    
+    def run_batches(batch_images, predict_args):
+        batch_results = []
+        for start in range(0, len(batch_images), batch_size):
+            chunk = batch_images[start:start + batch_size]
+            try:
+                batch_results.extend(models[model_key].predict(chunk, conf=0.25, batch=len(chunk), verbose=False, **predict_args))
+            except Exception as e:
+                print(f"{model_key} batch error: {e}")
+                batch_results.extend([None] * len(chunk))
+        return batch_results
+    
+    def run_uncached(batch_images):
+        if TILED_INFERENCE and any(needs_tiling(image) for image in batch_images):
+            # Large photos are tiled one by one, the rest stay batched
+            large = [i for i, image in enumerate(batch_images) if needs_tiling(image)]
+            small = [i for i in range(len(batch_images)) if i not in large]
+            batch_results = [None] * len(batch_images)
+            for i in large:
+                batch_results[i] = predict_tiled(models, model_key, batch_images[i], conf=0.25)[0]
+            for i, result in zip(small, run_uncached([batch_images[i] for i in small])):
+                batch_results[i] = result
+            return batch_results
+        if not ADAPTIVE_RESOLUTION:
+            return run_batches(batch_images, {})
+        # Cheap low-resolution pass first, then escalate only the hard images
+        batch_results = run_batches(batch_images, {'imgsz': LOW_RES_IMGSZ})
+        escalate = [i for i, result in enumerate(batch_results) if result is None or needs_escalation([result])]
+        stats.increment('adaptive_requests', len(batch_images))
+        stats.increment('adaptive_escalations', len(escalate))
+        if escalate:
+            for i, result in zip(escalate, run_batches([batch_images[i] for i in escalate], {'imgsz': DETECT_IMGSZ})):
+                batch_results[i] = result
+        return batch_results
+    
+    if RESULT_CACHE_ENABLED and image_hashes:
+        # Only images the cache hasn't seen go through the model
+        cache = get_result_cache()
+        keys = [result_cache_key(models, model_key, image_hash, {'conf': 0.25}) if image_hash else None for image_hash in image_hashes]
+        results = [None] * len(images)
+        todo = []
+        for i, key in enumerate(keys):
+            boxes = cache.get(key) if key else None
+            if boxes is None:
+                todo.append(i)
+            else:
+                results[i] = Results(orig_img=images[i], path="", names=models[model_key].names, boxes=torch.from_numpy(boxes.copy()))
+        for i, result in zip(todo, run_uncached([images[i] for i in todo])):
+            results[i] = result
+            if result is not None and keys[i]:
+                cache.put(keys[i], result.boxes.data.cpu().numpy().astype(np.float32))
+    else:
+        results = run_uncached(images)
+    
+    outputs = []
+    for result in results:
+        if result is None:
+            outputs.append((None, 0))
+        else:
+            outputs.append(([result], len(result.boxes) if hasattr(result, 'boxes') else 0))
+    return outputs
+
+def run_batch_pipeline(image_files, models, mode, progress=None):
+    """
+    Batch Pipeline - Analyze many images with batched model calls
+    
+    Args:
+        image_files: List of uploaded image files
+        models: Dictionary containing all models
+        mode: Selected analysis mode (Auto-Detect or a manual mode)
+        progress: Optional st.progress bar to update
+    
+    Returns:
+        list: One dict per image with file, summary, analysis and history mode
+    """
+    # =========================================================================
+    # DECODE ALL IMAGES
+    # =========================================================================
+    items = []
+    for image_file in image_files:
+        image = ingest_image(image_file)
+        items.append({
+            'file': image_file,
+            'data': image.data if image is not None else None,
+            'image': image.bgr if image is not None else None,
+            'hash': image.digest if image is not None else None,
+            'experts': [],
+            'outputs': {},
+            'routing': None
+        })
+    valid = [item for item in items if item['image'] is not None]
+    
+    # =========================================================================
+    # DECIDE WHICH EXPERT(S) EACH IMAGE NEEDS
+    # =========================================================================
+    for item in valid:
+        if mode == "Tomato Fruit Only":
+            item['experts'] = ['fruit_expert']
+        elif mode == "Tomato Leaf Only":
+            item['experts'] = ['leaf_expert']
+        else:
+            item['experts'] = ['fruit_expert', 'leaf_expert']
+            if AUTO_DETECT_ROUTING == "gatekeeper" and 'gatekeeper' in models:
+                item['routing'] = classify_with_gatekeeper(models, item['image'])
+                route = item['routing']['route']
+                if route == "invalid":
+                    item['experts'] = []
+                elif route == "fruit":
+                    item['experts'] = ['fruit_expert']
+                elif route == "leaf":
+                    item['experts'] = ['leaf_expert']
+    
+    # =========================================================================
+    # RUN EACH EXPERT ON ITS IMAGES IN BATCHES
+    # =========================================================================
+    expert_keys = ['fruit_expert', 'leaf_expert']
+    for step, model_key in enumerate(expert_keys):
+        todo = [item for item in valid if model_key in item['experts']]
+        if todo:
+            print(f"BATCH MODE: Running {model_key} on {len(todo)} image(s)")
+            outputs = predict_batch(models, model_key, [item['image'] for item in todo],
+                                    image_hashes=[item['hash'] for item in todo])
+            for item, output in zip(todo, outputs):
+                item['outputs'][model_key] = output
+        if progress is not None:
+            progress.progress((step + 1) / len(expert_keys))
+    
+    # =========================================================================
+    # ANALYZE EACH IMAGE
+    # =========================================================================
+    rows = []
+    for item in items:
+        fruit_results, fruit_count = item['outputs'].get('fruit_expert', (None, 0))
+        leaf_results, leaf_count = item['outputs'].get('leaf_expert', (None, 0))
+        fruit_detections = to_detections(fruit_results, models['fruit_expert'].names, "fruit") if fruit_count else None
+        leaf_detections = to_detections(leaf_results, models['leaf_expert'].names, "leaf") if leaf_count else None
+        if DUPLICATE_SUPPRESSION and fruit_detections is not None and leaf_detections is not None:
+            fruit_detections, leaf_detections, suppressed = suppress_duplicates(fruit_detections, leaf_detections)
+            fruit_count, leaf_count = len(fruit_detections), len(leaf_detections)
+            get_pipeline_stats().increment('duplicates_suppressed', suppressed)
+        row = {'file': item['file'], 'data': item['data'], 'analysis': None, 'mode_for_history': mode,
+               'detections': None, 'image_size': None}
+        
+        if item['image'] is None:
+            row['summary'] = {'status': 'error', 'fruit_count': 0, 'leaf_count': 0}
+        elif item['routing'] and item['routing']['route'] == "invalid":
+            row['summary'] = {'status': 'invalid_image', 'fruit_count': 0, 'leaf_count': 0}
+        elif fruit_count + leaf_count == 0:
+            row['summary'] = {'status': 'nothing_detected', 'fruit_count': 0, 'leaf_count': 0}
+        else:
+            row['summary'] = {'status': 'detected', 'fruit_count': fruit_count, 'leaf_count': leaf_count}
+            row['detections'] = concat_detections([fruit_detections, leaf_detections])
+            row['image_size'] = (item['image'].shape[1], item['image'].shape[0])
+            if mode in ["Tomato Fruit Only", "Tomato Leaf Only"]:
+                detections = fruit_detections if mode == "Tomato Fruit Only" else leaf_detections
+                row['analysis'] = analyze_manual_results(detections, mode, models)
+            else:
+                row['analysis'] = analyze_combined_results({
+                    'fruit': fruit_detections,
+                    'leaf': leaf_detections
+                }, row['summary'], models)
+                if fruit_count > 0 and leaf_count > 0:
+                    row['mode_for_history'] = "Fruit & Leaf"
+                elif fruit_count > 0:
+                    row['mode_for_history'] = "Tomato Fruit"
+                else:
+                    row['mode_for_history'] = "Tomato Leaf"
+        rows.append(row)
+    return rows
+
+# =============================================================================
+# VIDEO ANALYSIS (Keyframe detection + tracking in between)
+# =============================================================================
+def propagate_boxes(prev_gray, gray, boxes):
+    """Move boxes by the median optical flow of a 3x3 grid of points inside each"""
+    if len(boxes) == 0:
+        return boxes
+    grid = np.linspace(0.25, 0.75, 3)
+    fractions = np.stack(np.meshgrid(grid, grid), axis=-1).reshape(1, -1, 2)
+    points = boxes[:, None, :2] + fractions * (boxes[:, None, 2:] - boxes[:, None, :2])
+    start = points.reshape(-1, 1, 2).astype(np.float32)
+    moved, status, _ = cv2.calcOpticalFlowPyrLK(prev_gray, gray, start, None, winSize=(21, 21), maxLevel=3)
+    flow = (moved - start).reshape(len(boxes), -1, 2)
+    flow[status.reshape(len(boxes), -1) == 0] = np.nan
+    with np.errstate(all="ignore"):
+        shift = np.nan_to_num(np.nanmedian(flow, axis=1))
+    height, width = gray.shape[:2]
+    shifted = boxes + np.tile(shift, 2)
+    shifted[:, [0, 2]] = np.clip(shifted[:, [0, 2]], 0, width - 1)
+    shifted[:, [1, 3]] = np.clip(shifted[:, [1, 3]], 0, height - 1)
+    return shifted
+
+class BoxTracker:
+    """
+    Keeps an identity for every fruit / leaf across frames
+    
+    Keyframe detections are matched to existing tracks of the same expert
+    by IoU (greedy, best overlap first); unmatched detections start new
+    tracks and tracks unmatched for more than max_misses keyframes end.
+    Between keyframes the boxes are moved with optical flow.
+    """
+    
+    def __init__(self, iou_threshold, max_misses):
+        self.iou_threshold = iou_threshold
+        self.max_misses = max_misses
+        self.active = []
+        self.finished = []
+        self.next_id = 1
+    
+    def update(self, detections):
+        """detections: list of dicts with source, name, conf and box (xyxy array)"""
+        matched_tracks = set()
+        matched_detections = set()
+        for source in {d['source'] for d in detections} | {t['source'] for t in self.active}:
+            track_ids = [i for i, t in enumerate(self.active) if t['source'] == source]
+            detection_ids = [i for i, d in enumerate(detections) if d['source'] == source]
+            if not track_ids or not detection_ids:
+                continue
+            iou = box_iou(np.array([self.active[i]['box'] for i in track_ids]),
+                          np.array([detections[i]['box'] for i in detection_ids]))
+            for flat in np.argsort(-iou, axis=None):
+                row, col = divmod(int(flat), iou.shape[1])
+                if iou[row, col] < self.iou_threshold:
+                    break
+                track_id, detection_id = track_ids[row], detection_ids[col]
+                if track_id in matched_tracks or detection_id in matched_detections:
+                    continue
+                matched_tracks.add(track_id)
+                matched_detections.add(detection_id)
+                self._observe(self.active[track_id], detections[detection_id])
+        
+        still_active = []
+        for i, track in enumerate(self.active):
+            if i not in matched_tracks:
+                track['misses'] += 1
+            (still_active if track['misses'] <= self.max_misses else self.finished).append(track)
+        self.active = still_active
+        
+        for i, detection in enumerate(detections):
+            if i not in matched_detections:
+                track = {'id': self.next_id, 'source': detection['source'], 'votes': {}, 'hits': 0, 'misses': 0}
+                self.next_id += 1
+                self._observe(track, detection)
+                self.active.append(track)
+    
+    def _observe(self, track, detection):
+        track['box'] = detection['box']
+        track['name'] = detection['name']
+        track['conf'] = detection['conf']
+        track['votes'][detection['name']] = track['votes'].get(detection['name'], 0.0) + detection['conf']
+        track['hits'] += 1
+        track['misses'] = 0
+    
+    def propagate(self, prev_gray, gray):
+        if self.active:
+            boxes = propagate_boxes(prev_gray, gray, np.array([t['box'] for t in self.active]))
+            for track, box in zip(self.active, boxes):
+                track['box'] = box
+    
+    def counts(self):
+        """Unique objects per (source, class), each track counted once"""
+        counts = {}
+        for track in self.finished + self.active:
+            # A track keeps the class it was seen as most confidently overall
+            name = max(track['votes'], key=track['votes'].get)
+            counts[(track['source'], name)] = counts.get((track['source'], name), 0) + 1
+        return counts
+
+def open_video_writer(path_stem, fps, size):
+    """First codec the local OpenCV build can write (browser-friendly ones first)"""
+    for fourcc, extension in [("avc1", ".mp4"), ("VP80", ".webm"), ("mp4v", ".mp4")]:
+        path = path_stem + extension
+        writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*fourcc), fps, size)
+        if writer.isOpened():
+            return writer, path
+        writer.release()
+    return None, None
+
+def run_video_pipeline(video_file, models, mode, progress=None):
+    """
+    Video Pipeline - Keyframe detection with tracking in between
+    
+    The clip is decoded frame by frame from a temporary file. The expert
+    detectors only run on keyframes (every VIDEO_MAX_KEYFRAME_INTERVAL
+    frames, sooner when the scene changes); boxes are tracked through the
+    frames in between so each fruit and leaf is counted once.
+    
+    Args:
+        video_file: Uploaded video file
+        models: Dictionary containing all models
+        mode: Selected analysis mode (Auto-Detect or a manual mode)
+        progress: Optional st.progress bar to update
+    
+    Returns:
+        tuple: (annotated_video_bytes, counts, stats) - the bytes are None
+        when no video writer is available; the temporary files are removed
+    """
+    if mode == "Tomato Fruit Only":
+        expert_keys = ['fruit_expert']
+    elif mode == "Tomato Leaf Only":
+        expert_keys = ['leaf_expert']
+    else:
+        expert_keys = ['fruit_expert', 'leaf_expert']
+    
+    work_dir = tempfile.mkdtemp(prefix="tomato_video_")
+    capture = None
+    writer = None
+    video_bytes = None
+    try:
+        source_path = os.path.join(work_dir, "input" + os.path.splitext(video_file.name)[1])
+        video_file.seek(0)
+        with open(source_path, "wb") as f:
+            shutil.copyfileobj(video_file, f, 1024 * 1024)
+        
+        capture = cv2.VideoCapture(source_path)
+        fps = capture.get(cv2.CAP_PROP_FPS) or 25.0
+        total_frames = int(capture.get(cv2.CAP_PROP_FRAME_COUNT)) or 0
+        tracker = BoxTracker(VIDEO_TRACK_IOU, VIDEO_MAX_MISSES)
+        output_path = None
+        stats = {'frames': 0, 'keyframes': 0, 'detector_calls': 0}
+        
+        prev_gray = None
+        key_thumb = None
+        since_key = VIDEO_MAX_KEYFRAME_INTERVAL
+        start = time.perf_counter()
+        while True:
+            ok, frame = capture.read()
+            if not ok:
+                break
+            if frame.shape[1] > VIDEO_WIDTH:
+                scale = VIDEO_WIDTH / frame.shape[1]
+                frame = cv2.resize(frame, (VIDEO_WIDTH, int(frame.shape[0] * scale)), interpolation=cv2.INTER_AREA)
+            gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        
+            # Adaptive sampling: a keyframe every N frames, sooner if the view changed
+            thumb = cv2.resize(gray, (64, 36), interpolation=cv2.INTER_AREA).astype(np.float32)
+            motion = float(np.abs(thumb - key_thumb).mean()) if key_thumb is not None else float("inf")
+            is_keyframe = since_key >= VIDEO_MAX_KEYFRAME_INTERVAL or (
+                since_key >= VIDEO_MIN_KEYFRAME_INTERVAL and motion > VIDEO_MOTION_THRESHOLD
+            )
+        
+            if is_keyframe:
+                outputs, _ = run_experts(models, expert_keys, frame)
+                stats['detector_calls'] += len(outputs)
+                found = {
+                    model_key: to_detections(results, models[model_key].names, "fruit" if model_key == "fruit_expert" else "leaf")
+                    for model_key, (results, count) in outputs.items() if count
+                }
+                if DUPLICATE_SUPPRESSION and len(found) == 2:
+                    found['fruit_expert'], found['leaf_expert'], _ = suppress_duplicates(found['fruit_expert'], found['leaf_expert'])
+                found = concat_detections(list(found.values()))
+                tracker.update([
+                    {'source': source, 'name': name, 'conf': conf, 'box': box}
+                    for box, name, conf, source in zip(found.xyxy, found.name.tolist(), found.conf.tolist(), found.source.tolist())
+                ])
+                key_thumb = thumb
+                since_key = 0
+                stats['keyframes'] += 1
+            else:
+                tracker.propagate(prev_gray, gray)
+                since_key += 1
+        
+            # Draw the tracked boxes
+            for track in tracker.active:
+                if track['misses'] > 0:
+                    continue
+                x1, y1, x2, y2 = track['box'].astype(int)
+                healthy = detection_category(track['name'], track['source']) == "healthy" or track['name'].lower() == "ripe"
+                color = (80, 175, 76) if healthy else (54, 67, 244)
+                cv2.rectangle(frame, (x1, y1), (x2, y2), color, 3)
+                cv2.putText(frame, f"#{track['id']} {track['name']}", (x1, max(15, y1 - 8)),
+                            cv2.FONT_HERSHEY_SIMPLEX, 0.6, color, 2)
+        
+            if writer is None:
+                writer, output_path = open_video_writer(os.path.join(work_dir, "annotated"), fps, (frame.shape[1], frame.shape[0]))
+            if writer is not None:
+                writer.write(frame)
+        
+            prev_gray = gray
+            stats['frames'] += 1
+            if progress is not None and total_frames:
+                progress.progress(min(1.0, stats['frames'] / total_frames))
+        
+        if writer is not None:
+            writer.release()
+            writer = None
+            with open(output_path, "rb") as f:
+                video_bytes = f.read()
+    finally:
+        # Nothing of the clip stays on disk once the bytes are in memory
+        if capture is not None:
+            capture.release()
+        if writer is not None:
+            writer.release()
+        shutil.rmtree(work_dir, ignore_errors=True)
+    stats['elapsed_ms'] = (time.perf_counter() - start) * 1000
+    print(f"VIDEO: {stats['frames']} frame(s), {stats['keyframes']} keyframe(s), {tracker.next_id - 1} track(s)")
+    return video_bytes, tracker.counts(), stats
+
 # =============================================================================
 # LOAD USER HISTORY ON LOGIN (MOVED HERE - AFTER FUNCTION DEFINITIONS)
 # =============================================================================
@@ -1526,19 +4300,138 @@ elif st.session_state.get('logged_in') and st.session_state.get('history_loaded'
 # =============================================================================
 # MAIN LOGIC - With Manual Mode Selection Support
 # =============================================================================
-if submit_button and (camera_image or uploaded_file):
+if submit_button and video_mode and uploaded_video:
+    # =============================================================================
+    # VIDEO MODE: Keyframe detection, tracking, annotated clip + unique counts
+    # =============================================================================
+    st.info(f"🎬 Video Mode: analyzing {uploaded_video.name} ({analysis_mode})")
+    progress = st.progress(0.0)
+    request_models = models.pin()
+    with st.spinner("🔍 Analyzing video..."):
+        video_bytes, video_counts, video_stats = run_video_pipeline(uploaded_video, request_models, analysis_mode, progress=progress)
+    request_models.release()
+    
+    st.markdown("---")
+    st.markdown("<h2 style='text-align: center;'>Video Results</h2>", unsafe_allow_html=True)
+    if video_bytes:
+        st.video(video_bytes)
+    else:
+        st.warning("⚠️ Annotated video could not be written on this server")
+    
+    table = [
+        {"Source": "🍅 Fruit" if source == "fruit" else "🌿 Leaf", "Class": name.replace('-', ' ').replace('_', ' ').title(), "Count": count}
+        for (source, name), count in sorted(video_counts.items())
+    ]
+    if table:
+        st.dataframe(table, use_container_width=True, hide_index=True)
+    else:
+        st.info("No tomato fruit or leaf detected in the video.")
+    st.caption(
+        f"⏱️ {video_stats['frames']} frame(s), {video_stats['keyframes']} keyframe(s), "
+        f"{video_stats['detector_calls']} detector call(s) in {video_stats['elapsed_ms'] / 1000:.1f} s"
+    )
+    
+    # One history entry for the whole clip
+    video_diseases = [
+        {'name': name} for (source, name) in video_counts if detection_category(name, source) == "disease"
+    ]
+    save_scan_to_history(
+        mode=f"Video ({analysis_mode})",
+        status="Unhealthy" if video_diseases else "Healthy",
+        ripeness=None,
+        diseases=video_diseases,
+        model_versions=request_models.used_versions()
+    )
+
+elif submit_button and batch_mode and uploaded_files:
+    # =============================================================================
+    # BATCH MODE: Many uploads, batched model calls, one history entry each
+    # =============================================================================
+    st.info(f"📚 Batch Mode: analyzing {len(uploaded_files)} image(s) ({analysis_mode})")
+    batch_start = time.perf_counter()
+    progress = st.progress(0.0)
+    # One model version for the whole batch, even if a new one is swapped in
+    request_models = models.pin()
+    with st.spinner(f"🔍 Analyzing {len(uploaded_files)} image(s)..."):
+        batch_rows = run_batch_pipeline(uploaded_files, request_models, analysis_mode, progress=progress)
+    request_models.release()
+    
+    STATUS_LABELS = {
+        'error': "Could Not Read Image",
+        'invalid_image': "Not A Tomato Image",
+        'nothing_detected': "Nothing Detected"
+    }
+    table = []
+    for row in batch_rows:
+        analysis = row['analysis']
+        status = analysis['health_status'] if analysis else STATUS_LABELS[row['summary']['status']]
+        
+        # Save every readable image to history
+        if row['summary']['status'] != 'error':
+            save_scan_to_history(
+                mode=row['mode_for_history'],
+                status=status,
+                ripeness=analysis['ripeness'] if analysis else None,
+                diseases=analysis['diseases'] if analysis else [],
+                image_data=row['data'],
+                model_versions=request_models.used_versions(),
+                detections=row['detections'],
+                image_size=row['image_size']
+            )
+        
+        table.append({
+            "Image": row['file'].name,
+            "Status": status,
+            "Ripeness": (analysis['ripeness'] if analysis else None) or "N/A",
+            "Diseases": ", ".join(d['name'].replace('-', ' ').title() for d in analysis['diseases']) if analysis and analysis['diseases'] else "None",
+            "Fruit Detections": row['summary']['fruit_count'],
+            "Leaf Detections": row['summary']['leaf_count']
+        })
+    batch_ms = (time.perf_counter() - batch_start) * 1000
+    
+    st.markdown("---")
+    st.markdown("<h2 style='text-align: center;'>Batch Results</h2>", unsafe_allow_html=True)
+    st.dataframe(table, use_container_width=True, hide_index=True)
+    unhealthy = sum(1 for row in table if row["Status"] == "Unhealthy")
+    st.info(f"📊 **{len(table)} image(s) analyzed** - {unhealthy} unhealthy")
+    st.caption(f"⏱️ total: {batch_ms:.0f} ms | per image: {batch_ms / max(1, len(table)):.0f} ms | batch size: {BATCH_SIZE}")
+
+elif submit_button and (camera_image or uploaded_file):
     input_image = camera_image if camera_image else uploaded_file
+    # Finish this request on the model versions it starts with
+    request_models = models.pin()
+    # Lazily loaded models (export, INT8 check, warmup) are loaded before the
+    # budget starts so a cold start isn't reported as a busy server
+    if analysis_mode == "Tomato Fruit Only":
+        needed_models = ['fruit_expert']
+    elif analysis_mode == "Tomato Leaf Only":
+        needed_models = ['leaf_expert']
+    else:
+        needed_models = ['fruit_expert', 'leaf_expert']
+        if AUTO_DETECT_ROUTING == "gatekeeper" and 'gatekeeper' in models:
+            needed_models.append('gatekeeper')
+    if not all(models.is_loaded(model_key) for model_key in needed_models):
+        with st.spinner("🚀 Loading AI models..."):
+            for model_key in needed_models:
+                models[model_key]
+    # The budget starts before decoding; the upload is read and decoded once
+    # and every stage below works on that one buffer
+    deadline = Deadline(REQUEST_BUDGET_MS)
+    image = ingest_image(input_image)
+    if image is None:
+        st.error(f"❌ Could not read this image. Please upload a JPG, PNG, WEBP, BMP or TIFF photo of at most {MAX_IMAGE_PIXELS / 1e6:.0f} MP.")
     
     # =============================================================================
     # ROUTE BASED ON SELECTED MODE
     # =============================================================================
     
     # MANUAL MODE: User selected specific model
-    if analysis_mode in ["Tomato Fruit Only", "Tomato Leaf Only"]:
+    elif analysis_mode in ["Tomato Fruit Only", "Tomato Leaf Only"]:
         st.info(f"🎯 Running in Manual Mode: {analysis_mode}")
         
         # Run manual mode pipeline
-        output_image, results, summary = run_manual_mode_pipeline(input_image, models, analysis_mode)
+        output_image, detections, summary = run_manual_mode_pipeline(image, request_models, analysis_mode, deadline=deadline)
+        request_models.release()
         
         # CASE 1: Nothing detected
         if summary['status'] == 'nothing_detected':
@@ -1561,25 +4454,36 @@ if submit_button and (camera_image or uploaded_file):
                 else:
                     st.markdown("<p style='text-align: center; color: #757575;'>No tomato leaf detected in the image. The image may contain a fruit or other object.</p>", unsafe_allow_html=True)
         
+        # CASE 1c: The analysis ran out of time
+        elif summary['status'] == 'deadline_exceeded':
+            st.markdown("---")
+            st.error(f"⏳ The analysis did not finish within {REQUEST_BUDGET_MS / 1000:.0f} s. The server is busy - please try again.")
+        
         # CASE 2: Something detected in manual mode
         elif summary['status'] == 'detected':
             # Analyze what was found
-            analysis = analyze_manual_results(results, analysis_mode, models)
+            analysis = analyze_manual_results(detections, analysis_mode, request_models)
+            saved_detections = detections
             
             # Save to history
-            if hasattr(input_image, 'seek'):
-                input_image.seek(0)
             save_scan_to_history(
                 mode=analysis_mode,
                 status=analysis['health_status'],
                 ripeness=analysis['ripeness'],
                 diseases=analysis['diseases'],
-                image_file=input_image
+                image_data=image.data,
+                model_versions=request_models.used_versions(),
+                degraded=summary.get('degraded'),
+                detections=saved_detections,
+                image_size=(image.bgr.shape[1], image.bgr.shape[0]),
+                annotated_image=output_image
             )
             
             # Display results
             st.markdown("---")
             st.markdown("<h2 style='text-align: center;'>Analysis Result</h2>", unsafe_allow_html=True)
+            if summary.get('degraded'):
+                st.warning(f"⚡ Degraded result to stay within the time budget: {', '.join(summary['degraded'])}")
             
             # Show images
             col1, col2 = st.columns(2)
@@ -1667,7 +4571,8 @@ if submit_button and (camera_image or uploaded_file):
     # AUTO-DETECT MODE: Run both models
     else:  # analysis_mode == "Auto-Detect (Recommended)"
         # Run BOTH models on the image
-        output_image, combined_results, summary = run_ai_pipeline(input_image, models)
+        output_image, combined_results, summary = run_ai_pipeline(image, request_models, deadline=deadline)
+        request_models.release()
         
         # CASE 1: Nothing detected by either model
         if summary['status'] == 'nothing_detected':
@@ -1686,11 +4591,37 @@ if submit_button and (camera_image or uploaded_file):
             with col_status2:
                 st.markdown("<div style='text-align: center;'><span class='no-tomato-badge'>❌ NOTHING DETECTED</span></div>", unsafe_allow_html=True)
                 st.markdown("<p style='text-align: center; color: #757575;'>No tomato fruit or leaf detected in the image.</p>", unsafe_allow_html=True)
+            if summary.get('timings'):
+                st.caption(f"⏱️ {format_timings(summary['timings'])}")
+        
+        # CASE 1b: Gatekeeper says this is not a tomato image
+        elif summary['status'] == 'invalid_image':
+            st.markdown("---")
+            st.markdown("<h2 style='text-align: center;'>Analysis Result</h2>", unsafe_allow_html=True)
+            
+            col1, col2, col3 = st.columns([1, 2, 1])
+            with col2:
+                st.image(input_image, caption="Original Image", use_container_width=True)
+            
+            st.markdown("---")
+            st.markdown("<h3 style='text-align: center;'>Status</h3>", unsafe_allow_html=True)
+            col_status1, col_status2, col_status3 = st.columns([1, 2, 1])
+            with col_status2:
+                st.markdown("<div style='text-align: center;'><span class='no-tomato-badge'>❌ NOT A TOMATO IMAGE</span></div>", unsafe_allow_html=True)
+                st.markdown(f"<p style='text-align: center; color: #757575;'>The image was classified as '{summary['routing']['label']}' ({summary['routing']['confidence']:.1%}). Please upload a photo of a tomato fruit or leaf.</p>", unsafe_allow_html=True)
+            if summary.get('timings'):
+                st.caption(f"⏱️ {format_timings(summary['timings'])}")
+        
+        # CASE 1c: The analysis ran out of time
+        elif summary['status'] == 'deadline_exceeded':
+            st.markdown("---")
+            st.error(f"⏳ The analysis did not finish within {REQUEST_BUDGET_MS / 1000:.0f} s. The server is busy - please try again.")
         
         # CASE 2: Something was detected
         elif summary['status'] == 'detected':
             # Analyze what was found
-            analysis = analyze_combined_results(combined_results, summary, models)
+            analysis = analyze_combined_results(combined_results, summary, request_models)
+            saved_detections = concat_detections([combined_results['fruit'], combined_results['leaf']])
             
             # Determine mode for history saving
             if summary['fruit_count'] > 0 and summary['leaf_count'] > 0:
@@ -1701,19 +4632,24 @@ if submit_button and (camera_image or uploaded_file):
                 mode_for_history = "Tomato Leaf"
             
             # Save to history
-            if hasattr(input_image, 'seek'):
-                input_image.seek(0)
             save_scan_to_history(
                 mode=mode_for_history,
                 status=analysis['health_status'],
                 ripeness=analysis['ripeness'],
                 diseases=analysis['diseases'],
-                image_file=input_image
+                image_data=image.data,
+                model_versions=request_models.used_versions(),
+                degraded=summary.get('degraded'),
+                detections=saved_detections,
+                image_size=(image.bgr.shape[1], image.bgr.shape[0]),
+                annotated_image=output_image
             )
             
             # Display results
             st.markdown("---")
             st.markdown("<h2 style='text-align: center;'>Analysis Result</h2>", unsafe_allow_html=True)
+            if summary.get('degraded'):
+                st.warning(f"⚡ Degraded result to stay within the time budget: {', '.join(summary['degraded'])}")
             
             # Show images
             col1, col2 = st.columns(2)
@@ -1803,11 +4739,76 @@ if submit_button and (camera_image or uploaded_file):
                 for detection in analysis['leaf_detections']:
                     if detection['type'] == 'disease':
                         st.write(f"  • {detection['name']} ({detection['confidence']:.1%})")
+            
+            if summary.get('routing') and summary['routing']['label']:
+                routing = summary['routing']
+                st.caption(f"🚦 Gatekeeper: {routing['label']} ({routing['confidence']:.1%}) → {routing['route']}")
+            if summary.get('suppressed'):
+                st.caption(f"🧹 Merged {summary['suppressed']} box(es) reported by both the fruit and leaf models")
+            if summary.get('timings'):
+                st.caption(f"⏱️ {format_timings(summary['timings'])}")
 
 
 elif submit_button and not (camera_image or uploaded_file):
     st.warning("⚠️ Please capture or upload an image before analyzing!")
 
+# =============================================================================
+# INFERENCE STATS (Sidebar)
+# =============================================================================
+with st.sidebar:
+    with st.expander("⚙️ Inference Stats", expanded=False):
+        st.caption(f"Experts: {'parallel' if PARALLEL_EXPERTS else 'sequential'} | Routing: {AUTO_DETECT_ROUTING}")
+        st.caption(f"CPU: {describe_cpu_layout(cpu_layout)}")
+        for model_key in MODEL_FILES:
+            if models.is_loaded(model_key):
+                st.caption(describe_model(model_key, get_model_status()[model_key]))
+                pool = models[model_key].stats()
+                st.caption(
+                    f"↳ pool: {pool['busy']}/{pool['size']} busy, {pool['utilization']:.0%} utilized, "
+                    f"{pool['waits']}/{pool['checkouts']} waited (avg {pool['avg_wait_ms']:.0f} ms, max {pool['max_wait_ms']:.0f} ms)"
+                    + (f", {pool['recycles']} recycle(s)" if 'recycles' in pool else "")
+                )
+            else:
+                st.caption(f"{model_key}: not loaded")
+        if MICROBATCH_ENABLED:
+            batching = get_inference_scheduler(load_models()).stats()
+            st.caption(
+                f"Micro-batching: {batching['requests']} request(s) in {batching['batches']} batch(es), "
+                f"avg batch {batching['avg_batch']:.1f}, p99 {batching['p99_ms']:.0f} ms"
+            )
+        else:
+            st.caption("Micro-batching: off")
+        if ADAPTIVE_RESOLUTION:
+            adaptive_requests = get_pipeline_stats().get('adaptive_requests')
+            escalations = get_pipeline_stats().get('adaptive_escalations')
+            rate = escalations / adaptive_requests if adaptive_requests else 0.0
+            st.caption(f"Adaptive resolution ({LOW_RES_IMGSZ} → {DETECT_IMGSZ}): {escalations}/{adaptive_requests} escalated ({rate:.1%})")
+        else:
+            st.caption("Adaptive resolution: off")
+        if REQUEST_BUDGET_MS > 0:
+            stats = get_pipeline_stats()
+            levels = ["low_resolution", "single_expert", "expert_timeout", "no_render"]
+            st.caption(
+                f"Latency budget ({REQUEST_BUDGET_MS:.0f} ms): {stats.get('deadline_hits')}/{stats.get('deadline_requests')} hit, "
+                + ", ".join(f"{level} {stats.get('degraded_' + level)}" for level in levels)
+            )
+        if DUPLICATE_SUPPRESSION:
+            st.caption(f"Cross-model duplicates suppressed: {get_pipeline_stats().get('duplicates_suppressed')}")
+        if RESULT_CACHE_ENABLED:
+            cached = get_result_cache().stats()
+            st.caption(
+                f"Result cache: {cached['hits']} hit(s) / {cached['misses']} miss(es), "
+                f"{cached['entries']} entries ({cached['bytes'] / 1024:.0f} KB)"
+            )
+
+# =============================================================================
+# BACKGROUND MODEL PRELOAD (After the UI is up)
+# =============================================================================
+if LAZY_MODEL_LOADING:
+    start_model_preload(models)
+if MODEL_WATCH_ENABLED:
+    start_model_watcher(models)
+
 # =============================================================================
 # FOOTER
 # =============================================================================
@@ -0,0 +1,169 @@
+# =============================================================================
+# inference_worker.py
+# Out-of-process Inference Workers for Tomato Ripeness & Disease Checker
+# =============================================================================
+# Runs in separate worker processes started by app.py (WORKER_PROCESSES > 0).
+# Images arrive through shared memory, results go back as compact arrays.
+
+import os
+import sys
+import time
+from multiprocessing import resource_tracker, shared_memory
+from pathlib import Path
+
+import cv2
+import numpy as np
+import torch
+from ultralytics import YOLO
+
+
+# Model held by this worker process (set by init_worker)
+_model = None
+
+# =============================================================================
+# RUNTIME THREAD LIMITS (ONNX Runtime / OpenVINO)
+# =============================================================================
+def limit_runtime_threads(model, source, threads):
+    """
+    Apply a thread count to the runtime of an exported YOLO model
+
+    ONNX Runtime sizes its own intra-op pool and OpenVINO uses TBB; neither
+    reads OMP_NUM_THREADS or torch's setting. YOLO offers no way to pass
+    session options, so once its predictor has built the backend the ONNX
+    session is recreated with intra_op_num_threads, or the OpenVINO model
+    recompiled with INFERENCE_NUM_THREADS. PyTorch models are left alone.
+    """
+    if not threads:
+        return model
+
+    def apply(predictor):
+        backend = predictor.model
+        if getattr(backend, "_thread_limit", None) == threads:
+            return
+        if getattr(backend, "onnx", False) and hasattr(backend, "session"):
+            import onnxruntime
+
+            options = onnxruntime.SessionOptions()
+            options.intra_op_num_threads = threads
+            options.inter_op_num_threads = 1
+            backend.session = onnxruntime.InferenceSession(
+                source, options, providers=backend.session.get_providers()
+            )
+        elif getattr(backend, "xml", False) and hasattr(backend, "ov_compiled_model"):
+            import openvino as ov
+
+            xml = source if source.endswith(".xml") else next(Path(source).glob("*.xml"))
+            backend.ov_compiled_model = ov.Core().compile_model(
+                str(xml), "CPU", {"PERFORMANCE_HINT": "LATENCY", "INFERENCE_NUM_THREADS": threads}
+            )
+        backend._thread_limit = threads
+
+    model.add_callback("on_predict_start", apply)
+    return model
+
+def load_model(source, task, threads=None):
+    """YOLO model for a .pt file or an exported artifact, with its runtime thread limit"""
+    if source.endswith(".pt"):
+        return YOLO(source)
+    return limit_runtime_threads(YOLO(source, task=task), source, threads)
+
+# =============================================================================
+# WORKER SETUP
+# =============================================================================
+
+def init_worker(source, task, warmup_imgsz=None, intra_op=None, inter_op=None, cv2_threads=None,
+                core_sets=None, next_slot=None):
+    """
+    Load the model once per worker process and optionally warm it up
+
+    Thread counts and core pinning come from the app's CPU layout so that
+    concurrent workers do not fight over the same cores.
+    """
+    global _model
+    if core_sets and next_slot is not None and hasattr(os, "sched_setaffinity"):
+        with next_slot.get_lock():
+            slot = next_slot.value % len(core_sets)
+            next_slot.value += 1
+        if core_sets[slot]:
+            os.sched_setaffinity(0, core_sets[slot])
+    if intra_op:
+        torch.set_num_threads(intra_op)
+    if inter_op:
+        try:
+            torch.set_num_interop_threads(inter_op)
+        except RuntimeError:
+            pass
+    if cv2_threads:
+        cv2.setNumThreads(cv2_threads)
+
+    _model = load_model(source, task, intra_op)
+    if warmup_imgsz:
+        image = np.zeros((warmup_imgsz, warmup_imgsz, 3), dtype=np.uint8)
+        _model.predict(image, imgsz=warmup_imgsz, verbose=False)
+
+def model_names():
+    """Class names of the worker's model"""
+    return dict(_model.names)
+
+def memory_usage():
+    """Resident memory of this process in bytes (0 if unknown)"""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return 0
+
+# =============================================================================
+# INFERENCE
+# =============================================================================
+
+def attach_shared_memory(name):
+    """
+    Open a block the app created, without taking ownership of it
+
+    Attaching registers the block with the resource tracker. A tracker of
+    the worker's own would warn about a "leak" and unlink the block when
+    the worker exits while the app still owns it, so the registration is
+    dropped again. Spawned pool workers usually share the app's tracker
+    instead; there the entry is the app's own and must stay, or the app's
+    unlink would make the tracker fail. The app unlinks its blocks itself.
+    """
+    if sys.version_info >= (3, 13):
+        return shared_memory.SharedMemory(name=name, track=False)
+    block = shared_memory.SharedMemory(name=name)
+    # _pid is only set when this process started the tracker itself
+    if resource_tracker._resource_tracker._pid is not None:
+        resource_tracker.unregister(block._name, "shared_memory")
+    return block
+
+def run_inference(frames, predict_args):
+    """
+    Run the worker's model on images stored in shared memory
+
+    Args:
+        frames: List of (shared memory name, shape, dtype) - one per image
+        predict_args: Keyword arguments for model.predict (conf, imgsz, ...)
+
+    Returns:
+        tuple: (boxes, rss, run_ms)
+        - boxes: One float32 array per image, rows of x1, y1, x2, y2, conf, cls
+        - rss: Resident memory of this worker in bytes, used for recycling
+        - run_ms: Time spent in this worker, so the caller can tell queueing apart
+    """
+    start = time.perf_counter()
+    images = []
+    for name, shape, dtype in frames:
+        block = attach_shared_memory(name)
+        try:
+            # The predictor keeps references to its last input, so work on a
+            # private copy and release the shared block straight away
+            images.append(np.ndarray(shape, dtype=dtype, buffer=block.buf).copy())
+        finally:
+            block.close()
+
+    results = _model.predict(images if len(images) > 1 else images[0], batch=len(images), verbose=False, **predict_args)
+    boxes = [result.boxes.data.cpu().numpy().astype(np.float32) for result in results]
+    return boxes, memory_usage(), (time.perf_counter() - start) * 1000